@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+
+# On-disk cache of parsed ASTs, keyed by a hash of the preprocessed source, so unchanged files skip parsing entirely
+
+import hashlib
+import marshal
+import os
+import zlib
+
+import pycparser
+from pycparser import c_ast
+
+try:
+	from pycparser.c_parser import Coord
+except ImportError:
+	from pycparser.plyparser import Coord
+
+
+# Bump when the serialised layout below changes, to invalidate old cache entries
+FORMAT_VERSION = 1
+
+NODE = 0
+LIST = 1
+VALUE = 2
+
+
+def node_fields(node):
+	return [slot for slot in node.__slots__ if slot not in ('coord', '__weakref__')]
+
+
+def flatten_ast(ast):
+	# Flatten the AST into a table of nodes that reference each other by index. This is built without recursion (so
+	# deep expression chains can be stored), is much smaller than pickling the node objects, and preserves any sharing
+	# of nodes within the tree.
+	files = {}
+	indices = {id(ast): 0}
+	pending = [ast]
+	table = []
+
+	def encode(value):
+		if isinstance(value, c_ast.Node):
+			if id(value) not in indices:
+				indices[id(value)] = len(pending)
+				pending.append(value)
+			return NODE, indices[id(value)]
+		if isinstance(value, list) and any(isinstance(item, c_ast.Node) for item in value):
+			return LIST, [encode(item) for item in value]
+		return VALUE, value
+
+	for node in pending:
+		coord = node.coord
+		if coord is not None:
+			coord = (files.setdefault(coord.file, len(files)), coord.line, coord.column)
+		fields = [encode(getattr(node, slot)) for slot in node_fields(node)]
+		table.append((type(node).__name__, coord, fields))
+
+	return list(files), table
+
+
+def serialize_ast(ast):
+	files, table = flatten_ast(ast)
+	return zlib.compress(marshal.dumps((FORMAT_VERSION, files, table)))
+
+
+def ast_digest(nodes, *parts):
+	# Content hash of AST subtrees (including their coordinates), along with any other strings that affect their use
+	digest = hashlib.sha256()
+	for part in (str(FORMAT_VERSION), str(marshal.version), pycparser.__version__) + parts:
+		digest.update(part.encode() + b'\0')
+	for node in nodes:
+		digest.update(marshal.dumps(flatten_ast(node)))
+	return digest.hexdigest()
+
+
+def deserialize_ast(data):
+	version, files, table = marshal.loads(zlib.decompress(data))
+	if version != FORMAT_VERSION:
+		raise ValueError(f"unsupported AST cache format {version}")
+
+	# Create every node first, then fill in their fields, so that references can point forwards or backwards
+	nodes = [getattr(c_ast, name).__new__(getattr(c_ast, name)) for name, _, _ in table]
+
+	def decode(value):
+		kind, value = value
+		if kind == NODE:
+			return nodes[value]
+		if kind == LIST:
+			return [decode(item) for item in value]
+		return value
+
+	for node, (_, coord, fields) in zip(nodes, table):
+		if coord is not None:
+			coord = Coord(files[coord[0]], coord[1], coord[2])
+		node.coord = coord
+		for slot, value in zip(node_fields(node), fields):
+			setattr(node, slot, decode(value))
+
+	return nodes[0]
+
+
+class ASTCache:
+	def __init__(self, directory, max_size=512 * 1024 * 1024):
+		self.directory = directory
+		self.max_size = max_size
+		os.makedirs(directory, exist_ok=True)
+
+	def key(self, text, source_filename='', cpp_args=''):
+		digest = hashlib.sha256()
+		for part in (str(FORMAT_VERSION), str(marshal.version), pycparser.__version__, repr(cpp_args), source_filename):
+			digest.update(part.encode() + b'\0')
+		digest.update(text.encode())
+		return digest.hexdigest()
+
+	def path(self, key):
+		return os.path.join(self.directory, key[:2], key + '.ast')
+
+	def load(self, key):
+		path = self.path(key)
+		try:
+			with open(path, 'rb') as f:
+				data = f.read()
+			ast = deserialize_ast(data)
+		except (OSError, ValueError, EOFError, TypeError, AttributeError, zlib.error):
+			return None
+
+		# Record the access time ourselves, as file systems are often mounted without atime updates
+		try:
+			os.utime(path)
+		except OSError:
+			pass
+		return ast
+
+	def store(self, key, ast):
+		path = self.path(key)
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+
+		# Write to a temporary file and rename it into place, so concurrent readers never see partial entries
+		temporary = f"{path}.{os.getpid()}.tmp"
+		with open(temporary, 'wb') as f:
+			f.write(serialize_ast(ast))
+		os.replace(temporary, path)
+
+	def evict(self):
+		# Remove the least recently used entries (including any preprocessed source cached alongside) until the cache fits
+		# within its maximum size
+		entries = []
+		for directory, _, filenames in os.walk(self.directory):
+			for filename in filenames:
+				if filename.endswith(('.ast', '.cpp')):
+					path = os.path.join(directory, filename)
+					try:
+						stat = os.stat(path)
+					except FileNotFoundError:
+						continue
+					entries.append((stat.st_mtime, stat.st_size, path))
+
+		size = sum(entry[1] for entry in entries)
+		for _, entry_size, path in sorted(entries):
+			if size <= self.max_size:
+				break
+			try:
+				os.remove(path)
+			except FileNotFoundError:
+				pass
+			size -= entry_size
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+
+# Benchmark extraction over a synthetic, deeply nested expression: a single return statement summing many terms,
+# which pycparser turns into a left-deep chain of BinaryOp nodes
+
+import argparse
+import os
+import sys
+import time
+
+import pycparser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import expressions
+
+
+def deep_expression_source(terms):
+	return 'int f(int a, int b)\n{\n\treturn ' + ' + '.join(('a', 'b', '1')[i % 3] for i in range(terms)) + ';\n}\n'
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Benchmark extraction of a deeply nested expression.')
+	parser.add_argument('-n', '--terms', type=int, default=100000,
+	                    help='number of terms in the expression (default 100000)')
+	args = parser.parse_args()
+
+	source = deep_expression_source(args.terms)
+
+	start = time.perf_counter()
+	ast = pycparser.CParser().parse(source, 'deep.c')
+	parse_time = time.perf_counter() - start
+
+	start = time.perf_counter()
+	extraction = expressions.ExpressionExtractor().extract(ast)
+	extract_time = time.perf_counter() - start
+
+	nodes = len(extraction.ast_graph)
+	print(f"terms:   {args.terms}")
+	print(f"nodes:   {nodes}")
+	print(f"parse:   {parse_time:.3f}s")
+	print(f"extract: {extract_time:.3f}s ({extract_time / nodes * 1e6:.2f}us per node)")
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+# Benchmark peak memory when processing generated files of increasing numbers of functions, normally and with
+# --low-memory, whose peak should stay flat as files grow (each function being the same size)
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+from suite import generate_source
+
+EXPRESSIONS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'expressions.py')
+
+MODES = {
+	'graph': ['-d', '-l', 'none'],
+	'graph-low-memory': ['-d', '-l', 'none', '-m'],
+	'jsonl': ['-f', 'jsonl', '-o', os.devnull],
+	'jsonl-low-memory': ['-f', 'jsonl', '-o', os.devnull, '-m'],
+}
+
+
+def peak_memory(source_filename, arguments, directory):
+	# Run in a separate process, so each run's peak is its own, reading the peak back from its statistics
+	stats = os.path.join(directory, 'stats.jsonl')
+	if os.path.exists(stats):
+		os.remove(stats)
+	output = os.path.join(directory, 'out')
+	subprocess.run([sys.executable, EXPRESSIONS, '-t', output + '.ast', '-e', output + '.expr', '--stats', stats,
+	                *arguments, source_filename], check=True, stdout=subprocess.DEVNULL)
+	with open(stats) as f:
+		return json.loads(f.readline())['peak_memory']
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Benchmark peak memory with and without --low-memory.')
+	parser.add_argument('-f', '--functions', metavar='N', type=int, nargs='+', default=[10, 100, 1000],
+	                    help='numbers of functions in the generated files (default 10 100 1000)')
+	parser.add_argument('-s', '--statements', type=int, default=50, help='statements per function (default 50)')
+	parser.add_argument('--tolerance', metavar='MB', type=float, default=8,
+	                    help='fail if low memory peaks grow by more than this over the file sizes (default 8)')
+	args = parser.parse_args()
+
+	results = {mode: {} for mode in MODES}
+	with tempfile.TemporaryDirectory(prefix='expressions-memory-') as directory:
+		for functions in args.functions:
+			source_filename = os.path.join(directory, f'functions-{functions}.c')
+			with open(source_filename, 'w') as f:
+				f.write(generate_source(functions, args.statements))
+			for mode, arguments in MODES.items():
+				print(f"Measuring '{mode}' with {functions} functions...", file=sys.stderr)
+				results[mode][functions] = peak_memory(source_filename, arguments, directory)
+
+	print('functions\t' + '\t'.join(MODES))
+	for functions in args.functions:
+		print(f'{functions}\t' + '\t'.join(f'{results[mode][functions] / 2**20:.1f}MB' for mode in MODES))
+
+	# The low memory bound is independent of the number of functions
+	failed = False
+	for mode in MODES:
+		if mode.endswith('low-memory'):
+			peaks = list(results[mode].values())
+			growth = (max(peaks) - min(peaks)) / 2**20
+			if growth > args.tolerance:
+				print(f"'{mode}' peak memory grew by {growth:.1f}MB, more than {args.tolerance}MB", file=sys.stderr)
+				failed = True
+	return 1 if failed else 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+
+# Benchmark each stage of the pipeline separately (preprocess, parse, extraction walk, graph build, layout and write)
+# over the c-tests files and generated corpora that scale in function count, statement count and expression depth
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import pycparser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import expressions
+
+C_TESTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'c-tests')
+EXPRESSIONS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'expressions.py')
+
+# Modules that should only be imported once a file is actually processed
+HEAVY_MODULES = ['pycparser', 'pygraphviz', 'multiprocessing', 'concurrent.futures', 'sqlite3']
+
+SCALES = {
+	'functions': [1, 10, 100],
+	'statements': [10, 100, 1000],
+	'depth': [10, 100, 1000],
+}
+
+QUICK_SCALES = {
+	'functions': [1, 10],
+	'statements': [10, 100],
+	'depth': [10, 100],
+}
+
+
+def generate_source(functions=1, statements=10, depth=3):
+	# Each function declares some variables, then repeats assignments, increments and returns built from expressions
+	# with the given number of binary operators
+	lines = ['int g0, g1;', '']
+	for f in range(functions):
+		lines.append(f'int f{f}(int a, int b)')
+		lines.append('{')
+		lines.append('\tint c = a + 1;')
+		for s in range(statements):
+			terms = ' + '.join(('a', 'b', 'c', str(s))[(s + t) % 4] for t in range(depth + 1))
+			kind = s % 4
+			if kind == 0:
+				lines.append(f'\tc = {terms};')
+			elif kind == 1:
+				lines.append(f'\tg{s % 2} = ({terms}) * 2;')
+			elif kind == 2:
+				lines.append('\tc++;')
+			else:
+				lines.append(f'\tint v{s} = {terms};')
+		lines.append(f'\treturn c + {f};')
+		lines.append('}')
+		lines.append('')
+	return '\n'.join(lines)
+
+
+def corpora(scales):
+	for name in sorted(os.listdir(C_TESTS)):
+		if name.endswith('.c'):
+			yield name, {}, os.path.join(C_TESTS, name)
+	for dimension, sizes in scales.items():
+		for size in sizes:
+			yield f'{dimension}-{size}', {dimension: size}, None
+
+
+def timed(function, repeat):
+	# Return the result of the fastest run, along with its wall and CPU times
+	best = None
+	for _ in range(repeat):
+		wall, cpu = time.perf_counter(), time.process_time()
+		result = function()
+		wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+		if best is None or wall < best[1]:
+			best = (result, wall, cpu)
+	return best
+
+
+def benchmark(name, size, source_filename, options, directory):
+	if source_filename is None:
+		source_filename = os.path.join(directory, name + '.c')
+		with open(source_filename, 'w') as f:
+			f.write(generate_source(**size))
+
+	stages = {}
+
+	def stage(stage_name, function):
+		result, wall, cpu = timed(function, options.repeat)
+		stages[stage_name] = {'wall': round(wall, 6), 'cpu': round(cpu, 6)}
+		return result
+
+	text = stage('preprocess', lambda: pycparser.preprocess_file(source_filename, options.cpp, options.cppargs))
+	ast = stage('parse', lambda: pycparser.CParser().parse(text, source_filename))
+	stage('walk', lambda: expressions.ExpressionExtractor(graphs=False).extract(ast))
+	extraction = stage('extract', lambda: expressions.ExpressionExtractor().extract(ast))
+	graphs = stage('graph', lambda: (extraction.ast_graph.to_agraph(), extraction.expressions.to_agraph()))
+
+	# Layout is superlinear, so is skipped for large graphs
+	nodes = {'ast': len(extraction.ast_graph), 'expressions': len(extraction.expressions)}
+	if max(nodes.values()) <= options.max_layout_nodes:
+		stage('layout', lambda: [graph.layout('dot') for graph in graphs])
+	else:
+		stages['layout'] = None
+	output = os.path.join(directory, name)
+	stage('write', lambda: [graph.write(f'{output}.{index}.dot') for index, graph in enumerate(graphs)])
+
+	return {'name': name, 'size': size, 'source_bytes': len(text), 'nodes': nodes, 'stages': stages}
+
+
+def startup(options, directory):
+	# Time a cold start of the command line tool, as a user would see it, and the import of the expressions module
+	# alone, with compiled bytecode cached (in a separate directory) as it would be after the first run
+	environment = dict(os.environ, PYTHONPYCACHEPREFIX=os.path.join(directory, 'pycache'))
+	environment.pop('PYTHONDONTWRITEBYTECODE', None)
+	root = os.path.dirname(EXPRESSIONS)
+
+	def run(*arguments):
+		return subprocess.run([sys.executable, *arguments], env=environment, cwd=root, check=True,
+		                      stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True).stderr
+
+	# The first run writes the bytecode cache
+	run(EXPRESSIONS, '--help')
+	_, help_time, _ = timed(lambda: run(EXPRESSIONS, '--help'), options.repeat)
+
+	# Each line of -X importtime output is 'import time: self | cumulative | name', in microseconds
+	imports = {}
+	import_time = None
+	for _ in range(options.repeat):
+		lines = run('-X', 'importtime', '-c', 'import expressions').splitlines()
+		imports = {line.split('|')[2].strip(): int(line.split('|')[1].split(':')[-1]) for line in lines[1:]}
+		if import_time is None or imports['expressions'] < import_time:
+			import_time = imports['expressions']
+
+	return {
+		'help': round(help_time, 6),
+		'import': round(import_time / 1e6, 6),
+		'heavy_modules': [module for module in HEAVY_MODULES if module in imports],
+	}
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Benchmark each stage of expression extraction.')
+	parser.add_argument('-o', '--output', metavar='output_file', help='write JSON results to this file (default stdout)')
+	parser.add_argument('-n', '--repeat', type=int, default=3, help='runs of each stage, keeping the fastest (default 3)')
+	parser.add_argument('-q', '--quick', action='store_true', help='only run the smaller generated corpora')
+	parser.add_argument('-k', '--select', metavar='name', action='append',
+	                    help='only run corpora whose name contains this (may be repeated)')
+	parser.add_argument('--max-layout-nodes', metavar='N', type=int, default=5000,
+	                    help='skip layout for graphs with more than N nodes (default 5000)')
+	parser.add_argument('-c', '--cpp', metavar='cpp_path', default='cpp',
+	                    help="path to C preprocessor executable (default 'cpp')")
+	parser.add_argument('-a', '--cppargs', metavar='cpp_args', default='',
+	                    help='additional C preprocessor arguments (default none)')
+	parser.add_argument('--startup-budget', metavar='MS', type=float, default=100,
+	                    help='fail if starting the command line tool takes longer than this (default 100)')
+	args = parser.parse_args()
+
+	results = []
+	with tempfile.TemporaryDirectory(prefix='expressions-bench-') as directory:
+		print('Benchmarking start-up...', file=sys.stderr)
+		start_up = startup(args, directory)
+		for name, size, source_filename in corpora(QUICK_SCALES if args.quick else SCALES):
+			if args.select and not any(selected in name for selected in args.select):
+				continue
+			print(f"Benchmarking '{name}'...", file=sys.stderr)
+			results.append(benchmark(name, size, source_filename, args, directory))
+
+	report = {
+		'python': platform.python_version(),
+		'pycparser': pycparser.__version__,
+		'platform': platform.platform(),
+		'repeat': args.repeat,
+		'startup': start_up,
+		'results': results,
+	}
+	if args.output is None:
+		json.dump(report, sys.stdout, indent='\t')
+		print()
+	else:
+		with open(args.output, 'w') as f:
+			json.dump(report, f, indent='\t')
+
+	# Start-up should stay quick, which needs the parser, graphviz and the rest left unimported until they are used
+	failed = False
+	if start_up['help'] * 1000 > args.startup_budget:
+		print(f"Start-up took {start_up['help'] * 1000:.1f}ms, more than {args.startup_budget}ms", file=sys.stderr)
+		failed = True
+	if start_up['heavy_modules']:
+		print('Importing expressions also imported ' + ', '.join(start_up['heavy_modules']), file=sys.stderr)
+		failed = True
+	return 1 if failed else 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())
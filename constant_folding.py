@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+
+# Constant folding of extracted expressions, evaluating integer constant subexpressions as C would, with the type sizes
+# of GCC on x86-64 Linux (LP64, with plain char signed)
+
+import re
+
+BOOL, CHAR, SHORT, INT, LONG, LONG_LONG = range(6)
+
+# Width of the integer types of each rank
+BITS = [1, 8, 16, 32, 64, 64]
+
+SPECIFIERS = {'_Bool', 'char', 'short', 'int', 'long', 'signed', 'unsigned'}
+
+INTEGER = re.compile(r'(0[xX][0-9a-fA-F]+|0[bB][01]+|0[0-7]*|[1-9][0-9]*)(?:([uU])(ll|LL|l|L)?|(ll|LL|l|L)([uU])?)?$')
+
+CHARACTER = re.compile(r"'(\\x[0-9a-fA-F]+|\\[0-7]{1,3}|\\.|[^'\\])'$")
+
+ESCAPES = {'n': 10, 't': 9, 'r': 13, 'a': 7, 'b': 8, 'f': 12, 'v': 11, '\\': 92, "'": 39, '"': 34, '?': 63}
+
+# The types an integer constant may have, in order, by whether it is decimal and its suffix
+CONSTANT_TYPES = {
+	(True, False, 0): [(INT, True), (LONG, True), (LONG_LONG, True)],
+	(False, False, 0): [(INT, True), (INT, False), (LONG, True), (LONG, False), (LONG_LONG, True), (LONG_LONG, False)],
+	(True, True, 0): [(INT, False), (LONG, False), (LONG_LONG, False)],
+	(True, False, 1): [(LONG, True), (LONG_LONG, True)],
+	(False, False, 1): [(LONG, True), (LONG, False), (LONG_LONG, True), (LONG_LONG, False)],
+	(True, True, 1): [(LONG, False), (LONG_LONG, False)],
+	(True, False, 2): [(LONG_LONG, True)],
+	(False, False, 2): [(LONG_LONG, True), (LONG_LONG, False)],
+	(True, True, 2): [(LONG_LONG, False)],
+}
+CONSTANT_TYPES.update({(False, True, longs): types for (_, unsigned, longs), types in list(CONSTANT_TYPES.items())
+                       if unsigned})
+
+COMPARISONS = {
+	'==': lambda a, b: a == b,
+	'!=': lambda a, b: a != b,
+	'<': lambda a, b: a < b,
+	'>': lambda a, b: a > b,
+	'<=': lambda a, b: a <= b,
+	'>=': lambda a, b: a >= b,
+}
+
+ARITHMETIC = {
+	'+': lambda a, b: a + b,
+	'-': lambda a, b: a - b,
+	'*': lambda a, b: a * b,
+	'&': lambda a, b: a & b,
+	'|': lambda a, b: a | b,
+	'^': lambda a, b: a ^ b,
+}
+
+
+def integer_type(name):
+	# The rank and signedness of an integer type named by its specifiers (e.g. 'unsigned long int'), or None
+	words = name.split() if name is not None else []
+	if not words or any(word not in SPECIFIERS for word in words):
+		return None
+	signed = 'unsigned' not in words
+	if '_Bool' in words:
+		return BOOL, False
+	if 'char' in words:
+		return CHAR, signed
+	if 'short' in words:
+		return SHORT, signed
+	if 'long' in words:
+		return (LONG if words.count('long') == 1 else LONG_LONG), signed
+	return INT, signed
+
+
+def fits(value, integer):
+	rank, signed = integer
+	bits = BITS[rank]
+	if signed:
+		return -(1 << (bits - 1)) <= value < 1 << (bits - 1)
+	return 0 <= value < 1 << bits
+
+
+def convert(value, integer):
+	# Convert a value to an integer type, wrapping it as GCC does where it does not fit
+	rank, signed = integer
+	if rank == BOOL:
+		return int(value != 0)
+	bits = BITS[rank]
+	value &= (1 << bits) - 1
+	if signed and value >= 1 << (bits - 1):
+		value -= 1 << bits
+	return value
+
+
+def promote(integer):
+	# Integer promotion: anything narrower than int is promoted to int, which can represent all its values
+	return (INT, True) if integer[0] < INT else integer
+
+
+def common_type(a, b):
+	# The usual arithmetic conversions of two (promoted) integer types
+	a, b = promote(a), promote(b)
+	if a[1] == b[1]:
+		return max(a, b)
+	signed, unsigned = (a, b) if a[1] else (b, a)
+	if unsigned[0] >= signed[0]:
+		return unsigned
+	if BITS[signed[0]] > BITS[unsigned[0]]:
+		return signed
+	return signed[0], False
+
+
+def constant_value(literal):
+	# The value and type of an integer or character constant, or None for anything else (e.g. floating point)
+	match = INTEGER.match(literal)
+	if match is not None:
+		digits, unsigned, longs, longs_first, unsigned_last = match.groups()
+		longs = longs or longs_first or ''
+		decimal = digits[0] != '0' or digits == '0'
+		value = int(digits, 0) if digits[:2].lower() in ('0x', '0b') or decimal else int(digits, 8)
+		for integer in CONSTANT_TYPES[decimal, bool(unsigned or unsigned_last), len(longs)]:
+			if fits(value, integer):
+				return value, integer
+		return None
+
+	# Character constants have type int, with the value of a (signed) char
+	match = CHARACTER.match(literal)
+	if match is None:
+		return None
+	character = match.group(1)
+	if character[0] != '\\':
+		value = ord(character)
+	elif character[1] == 'x':
+		value = int(character[2:], 16)
+	elif character[1] in '01234567':
+		value = int(character[1:], 8)
+	elif character[1] in ESCAPES:
+		value = ESCAPES[character[1]]
+	else:
+		return None
+	if value > 255:
+		return None
+	return convert(value, (CHAR, True)), (INT, True)
+
+
+def arithmetic(op, left, right):
+	# Apply a binary operator to two integer constants, or return None where the result is undefined (e.g. signed
+	# overflow, division by zero or shifting too far)
+	(a, a_type), (b, b_type) = left, right
+	if op in ('<<', '>>'):
+		integer = promote(a_type)
+		if b < 0 or b >= BITS[integer[0]]:
+			return None
+		if op == '>>':
+			return a >> b, integer
+		if integer[1] and a < 0:
+			return None
+		value = a << b
+	elif op in COMPARISONS:
+		integer = common_type(a_type, b_type)
+		return int(COMPARISONS[op](convert(a, integer), convert(b, integer))), (INT, True)
+	else:
+		integer = common_type(a_type, b_type)
+		a, b = convert(a, integer), convert(b, integer)
+		if op in ARITHMETIC:
+			value = ARITHMETIC[op](a, b)
+		elif op in ('/', '%'):
+			if b == 0:
+				return None
+			# Division truncates towards zero, and the remainder has the sign of the dividend
+			value = abs(a) // abs(b)
+			if (a < 0) != (b < 0):
+				value = -value
+			if op == '%':
+				value = a - b * value
+		else:
+			return None
+
+	if integer[1] and not fits(value, integer):
+		return None
+	return convert(value, integer), integer
+
+
+def unary(op, operand):
+	value, integer = operand
+	if op == '!':
+		return int(value == 0), (INT, True)
+	integer = promote(integer)
+	if op == '+':
+		return value, integer
+	if op == '~':
+		return convert(~value, integer), integer
+	if op == '-':
+		if integer[1] and not fits(-value, integer):
+			return None
+		return convert(-value, integer), integer
+	return None
+
+
+def fold_record(record):
+	# Evaluate every constant integer subexpression of an expression record, bottom-up, returning the value and type of
+	# each by node id. Record nodes are in pre-order, so walking them backwards reaches every child before its parent.
+	# A declaration's value is its initialiser's, converted to the declared type.
+	children = {}
+	values = {}
+	for node in reversed(record['nodes']):
+		operands = children.pop(node['id'], {})
+		kind = node['kind']
+		result = None
+		if kind == 'Constant':
+			result = constant_value(str(node['label']))
+		elif kind == 'BinaryOp':
+			left, right = operands.get('left'), operands.get('right')
+			op = node['label']
+			# Logical operators only evaluate their right operand if the left does not decide the result
+			if op in ('&&', '||') and left is not None:
+				if (left[0] != 0) == (op == '||'):
+					result = int(op == '||'), (INT, True)
+				elif right is not None:
+					result = int(right[0] != 0), (INT, True)
+			elif left is not None and right is not None:
+				result = arithmetic(op, left, right)
+		elif kind == 'UnaryOp' and 'expr' in operands:
+			# Unary operators are labelled either with their operator, or their full AST label ending with it
+			result = unary(node['label'].rpartition(' ')[2], operands['expr'])
+		elif kind == 'TernaryOp' and len(operands) == 3:
+			integer = common_type(operands['iftrue'][1], operands['iffalse'][1])
+			chosen = operands['iftrue' if operands['cond'][0] != 0 else 'iffalse']
+			result = convert(chosen[0], integer), integer
+		elif kind in ('Cast', 'Decl') and operands.get('expr' if kind == 'Cast' else 'init') is not None:
+			integer = integer_type(node.get('type'))
+			if integer is not None:
+				result = convert(operands['expr' if kind == 'Cast' else 'init'][0], integer), integer
+
+		if result is not None:
+			values[node['id']] = result
+			if node['parent'] is not None:
+				children.setdefault(node['parent'], {})[node['edge']] = result
+	return values
+
+
+class ConstantFolder:
+	# Sink for extracted expression records, adding the value of each constant subexpression to its node, and
+	# collecting those to collapse into single nodes in the expression graph being built
+	def __init__(self, collapse=False):
+		self.collapse = collapse
+		self.dropped = set()
+		self.folded = {}
+
+	def __call__(self, record):
+		values = fold_record(record)
+		for node in record['nodes']:
+			if node['id'] in values:
+				node['value'] = values[node['id']][0]
+
+		# The largest constant subexpressions with operators are collapsed, but never whole expressions
+		if self.collapse:
+			for node in record['nodes']:
+				if node['parent'] in self.dropped or node['parent'] in self.folded:
+					self.dropped.add(node['id'])
+				elif node['parent'] is not None and node['id'] in values and node['kind'] != 'Constant':
+					self.folded[node['id']] = (str(values[node['id']][0]), 'pink', 'square')
+
+	def collapse_extraction(self, extraction):
+		# Replace constant subexpressions seen since the last call by their values, returning the new extraction along
+		# with the nodes dropped from it
+		dropped, folded = self.dropped, self.folded
+		self.dropped, self.folded = set(), {}
+		if not self.collapse:
+			return extraction, dropped
+		return extraction._replace(expressions=extraction.expressions.collapse(dropped, {}, folded)), dropped
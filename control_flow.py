@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+
+# Control-flow layer of expression graphs, grouping expressions into the basic blocks they run in. Each block is a
+# cluster with a node naming it, joined to the blocks that can follow it by edges for the branches and loops of ifs,
+# switches and for, while and do loops (and breaks, continues, gotos and returns). It is built in the same pass over
+# the AST as the expressions, from the statements outside them as they are entered and left.
+
+BLOCK_COLOR = 'lightgrey'
+
+LOOPS = ('For', 'While', 'DoWhile')
+
+
+class Construct:
+	# A statement being walked that blocks are joined across: its first block (a loop's head), the block its condition
+	# is tested at the end of, a for loop's block for its next expression, the edges out of it so far, and where
+	# breaks, continues, gotos and labels lead
+	__slots__ = ('node_id', 'kind', 'name', 'tested', 'head', 'body', 'test', 'next', 'exits', 'breaks', 'continues',
+	             'default', 'returns', 'labels', 'gotos')
+
+	def __init__(self, node_id, kind, name=None, tested=True):
+		self.node_id = node_id
+		self.kind = kind
+		self.name = name
+		self.tested = tested
+		self.head = None
+		self.body = None
+		self.test = None
+		self.next = None
+		self.exits = None
+		self.breaks = []
+		self.continues = []
+		self.default = False
+		self.returns = []
+		self.labels = {}
+		self.gotos = []
+
+
+def case_label(node):
+	from pycparser import c_generator
+
+	return c_generator.CGenerator().visit(node)
+
+
+class ControlFlow:
+	def __init__(self, graph):
+		# Blocks are numbered with negative node ids, so they never clash with the AST's. The open block is the one new
+		# expressions go in, and when none is open the next block started is given the pending edges into it.
+		self.graph = graph
+		self.blocks = 0
+		self.current = None
+		self.pending = []
+		self.kind = 'file scope'
+		self.constructs = []
+		self.enter_handlers = {
+			'FuncDef': self.enter_function, 'If': self.enter_construct, 'Switch': self.enter_construct,
+			'For': self.enter_construct, 'While': self.enter_construct, 'DoWhile': self.enter_do,
+			'Return': self.enter_construct, 'Case': self.enter_case, 'Default': self.enter_case,
+			'Break': self.enter_break, 'Continue': self.enter_continue, 'Goto': self.enter_goto,
+			'Label': self.enter_label,
+		}
+
+	def add_block(self, kind, edges=()):
+		self.blocks += 1
+		block_id = -self.blocks
+		subgraph = self.graph.add_subgraph(0, f'cluster_block{self.blocks}', style='dotted')
+		self.graph.add_node(subgraph, block_id, kind, BLOCK_COLOR, 'box', 'filled,rounded')
+		self.current = (block_id, subgraph)
+		self.link(edges, block_id)
+		return block_id
+
+	def link(self, edges, block_id, label=None):
+		# Edges out of ended blocks, given a label if they have none
+		for tail_id, edge_label in edges:
+			self.graph.add_edge(0, tail_id, block_id, edge_label or label or '', 'forward')
+
+	def start(self):
+		if self.current is None:
+			self.add_block(self.kind, self.pending)
+			self.pending = []
+		return self.current[0]
+
+	def end(self, label=''):
+		# End the open block, returning the edges out of it (or the edges that were pending into the next block, when
+		# the code since they were is empty)
+		if self.current is not None:
+			self.pending = [(self.current[0], label)]
+			self.current = None
+		edges = self.pending
+		self.pending = []
+		return edges
+
+	def block(self):
+		# The cluster for an expression, in the open block or a new one
+		self.start()
+		return self.current[1]
+
+	def innermost(self, kinds):
+		return next((construct for construct in reversed(self.constructs) if construct.kind in kinds), None)
+
+	def enter(self, node, node_id, parent_id, edge_label):
+		# Called for each node outside expressions as the walk reaches it, before any expression it starts
+		if self.constructs and self.constructs[-1].node_id == parent_id:
+			self.enter_part(self.constructs[-1], edge_label)
+		handler = self.enter_handlers.get(type(node).__name__)
+		if handler is not None:
+			handler(node, node_id)
+
+	def enter_construct(self, node, node_id):
+		# A for loop without a condition never leaves other than by a break (or return or goto)
+		construct = Construct(node_id, type(node).__name__, tested=getattr(node, 'cond', True) is not None)
+		if construct.kind == 'While':
+			construct.head = self.add_block('while', self.end())
+		self.constructs.append(construct)
+
+	def enter_function(self, node, node_id):
+		self.end()
+		self.add_block(f'entry {node.decl.name}')
+		self.constructs.append(Construct(node_id, 'FuncDef', node.decl.name))
+
+	def enter_do(self, node, node_id):
+		# The condition of a do loop is walked before its body, so the condition's block is started out of order and
+		# the body's first block reopened after it
+		construct = Construct(node_id, 'DoWhile')
+		construct.head = self.add_block('do', self.end())
+		construct.body = self.current
+		self.constructs.append(construct)
+
+	def enter_part(self, construct, edge_label):
+		# Move on to a part of an if, switch or loop, ending the block its condition is tested at the end of
+		kind = construct.kind
+		if kind == 'For' and construct.head is None and edge_label in ('cond', 'next', 'stmt'):
+			# A for loop's initialisation runs once, before the head its condition is tested in
+			construct.head = self.add_block('for', self.end())
+		if kind == 'If':
+			if edge_label == 'iftrue':
+				construct.test = self.start()
+				self.end()
+				self.pending = [(construct.test, 'true')]
+				self.kind = 'then'
+			elif edge_label == 'iffalse':
+				construct.exits = self.end()
+				self.pending = [(construct.test, 'false')]
+				self.kind = 'else'
+		elif kind == 'Switch' and edge_label == 'stmt':
+			construct.test = self.start()
+			self.end()
+			self.kind = 'unreachable'
+		elif kind == 'For' and edge_label == 'next':
+			# The next expression runs after the body, in its own block joined back to the head after it
+			construct.test = construct.head
+			self.end()
+			construct.next = self.add_block('for next')
+		elif kind in ('For', 'While') and edge_label == 'stmt':
+			if construct.test is None:
+				construct.test = construct.head
+				self.end()
+			else:
+				self.link(self.end(), construct.head, 'loop')
+			self.pending = [(construct.test, 'true')]
+			self.kind = f'{kind.lower()} body'
+		elif kind == 'DoWhile':
+			if edge_label == 'cond':
+				self.end()
+				construct.test = self.add_block('do while')
+			elif edge_label == 'stmt':
+				self.end()
+				self.current = construct.body
+
+	def enter_case(self, node, node_id):
+		switch = self.innermost(('Switch',))
+		if switch is None or switch.test is None:
+			return
+		if type(node).__name__ == 'Case':
+			label = case_label(node.expr)
+			kind = f'case {label}'
+		else:
+			switch.default = True
+			label = kind = 'default'
+		self.add_block(kind, self.end() + [(switch.test, label)])
+
+	def enter_break(self, node, node_id):
+		construct = self.innermost(LOOPS + ('Switch',))
+		edges = self.end('break')
+		if construct is not None:
+			construct.breaks += edges
+		self.kind = 'unreachable'
+
+	def enter_continue(self, node, node_id):
+		construct = self.innermost(LOOPS)
+		edges = self.end('continue')
+		if construct is not None:
+			construct.continues += edges
+		self.kind = 'unreachable'
+
+	def enter_goto(self, node, node_id):
+		function = self.innermost(('FuncDef',))
+		edges = self.end('goto')
+		if function is not None:
+			function.gotos.append((edges, node.name))
+		self.kind = 'unreachable'
+
+	def enter_label(self, node, node_id):
+		function = self.innermost(('FuncDef',))
+		block_id = self.add_block(f'label {node.name}', self.end())
+		if function is not None:
+			function.labels[node.name] = block_id
+
+	def leave(self, node_id):
+		# Called when the walk has finished a node, joining the blocks of the innermost construct if it is this one
+		if not self.constructs or self.constructs[-1].node_id != node_id:
+			return
+		construct = self.constructs[-1]
+		kind = construct.kind
+		if kind == 'If':
+			if construct.test is None:
+				self.enter_part(construct, 'iftrue')
+			exits = self.end()
+			if construct.exits is None:
+				exits.append((construct.test, 'false'))
+			else:
+				exits += construct.exits
+			self.pending = exits
+		elif kind == 'Switch':
+			if construct.test is None:
+				self.enter_part(construct, 'stmt')
+			exits = self.end() + construct.breaks
+			if not construct.default:
+				exits.append((construct.test, 'default'))
+			self.pending = exits
+		elif kind in ('For', 'While'):
+			if construct.test is None:
+				self.enter_part(construct, 'stmt')
+			# The body loops back to the head, through the next expression's block if there is one
+			if construct.next is None:
+				self.link(self.end() + construct.continues, construct.head, 'loop')
+			else:
+				self.link(self.end() + construct.continues, construct.next)
+			self.pending = construct.breaks
+			if construct.tested:
+				self.pending = [(construct.test, 'false')] + construct.breaks
+		elif kind == 'DoWhile':
+			self.link(self.end() + construct.continues, construct.test)
+			self.link([(construct.test, 'true')], construct.head)
+			self.pending = [(construct.test, 'false')] + construct.breaks
+		elif kind == 'Return':
+			function = self.innermost(('FuncDef',))
+			edges = self.end('return')
+			if function is not None:
+				function.returns += edges
+		elif kind == 'FuncDef':
+			for edges, name in construct.gotos:
+				if name in construct.labels:
+					self.link(edges, construct.labels[name])
+			self.add_block(f'exit {construct.name}', self.end() + construct.returns)
+			self.current = None
+		self.constructs.pop()
+		kinds = {'Return': 'unreachable', 'FuncDef': 'file scope', 'DoWhile': 'end do'}
+		self.kind = kinds.get(kind, f'end {kind.lower()}')
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+# Def-use (data-flow) graphs, linking each read of a variable to the assignment, initialisation or increment that last
+# wrote it, built in one pass over extracted expression records
+
+from graph_ir import GraphIR
+
+
+def expression_accesses(record):
+	# Find where an expression record declares, defines, updates (reads then writes) and uses variables, as (node id,
+	# name, access) in pre-order. Declarators of the declaration being initialised are declarations, and assignment
+	# lvalues definitions. Compound assignments, increments and decrements, and assignments to an element or member of a
+	# variable are updates. Any other identifier is a use, apart from the names of called functions and members.
+	nodes = {}
+	accesses = []
+	for node in record['nodes']:
+		kind = node['kind']
+		parent = nodes.get(node['parent'])
+		access = 'use'
+		declaration = None
+		if parent is not None:
+			parent_kind, parent_label, declaration, parent_access = parent
+			edge = node['edge']
+			if parent_kind == 'Assignment' and edge == 'lvalue':
+				access = 'define' if parent_label == '=' else 'update'
+			elif parent_kind == 'UnaryOp' and edge == 'expr' and parent_label.endswith(('++', '--')):
+				access = 'update'
+			elif parent_kind in ('ArrayRef', 'StructRef') and edge == 'name' and parent_access != 'use':
+				access = 'update'
+			elif (parent_kind == 'FuncCall' and edge == 'name') or (parent_kind == 'StructRef' and edge == 'field'):
+				access = None
+		if kind == 'Decl':
+			declaration = node['id']
+		nodes[node['id']] = (kind, node['label'], declaration, access)
+
+		# Declarations nested in the one being initialised (e.g. parameters or members) are not variables in scope
+		if kind == 'ID' and access is not None:
+			accesses.append((node['id'], node['label'], access))
+		elif kind == 'TypeDecl' and declaration == record['id'] and node['label'] is not None:
+			accesses.append((node['id'], node['label'], 'declare'))
+	return accesses
+
+
+class DataFlow:
+	# Sink for extracted expression records, building a graph of each expression's variable accesses, with edges from
+	# definitions to the uses they reach. Definitions are looked up by name in symbol tables for the current function and
+	# for file scope, so building the graph is linear in the size of the expressions. Definitions reach every later use
+	# in the function, whatever the control flow, and block scopes and parameters are not distinguished from the
+	# function's other variables.
+	def __init__(self):
+		self.graph = None
+		self.take()
+
+	def take(self):
+		# Return the graph of the records seen since the last call, starting afresh (e.g. for the next shard)
+		graph = self.graph
+		self.graph = GraphIR(rankdir='LR')
+		self.function = None
+		self.locals = {}
+		self.globals = {}
+		return graph
+
+	def __call__(self, record):
+		accesses = expression_accesses(record)
+		if not accesses:
+			return
+		if record['function'] != self.function:
+			self.function = record['function']
+			self.locals = {}
+
+		# Uses are resolved before the expression's own definitions, which only reach later expressions
+		subgraph = self.graph.add_subgraph(0, f"cluster{record['id']}", label=record['coord'])
+		for node_id, name, access in accesses:
+			if access == 'use':
+				self.graph.add_node(subgraph, node_id, name, 'lightblue', 'square')
+			else:
+				self.graph.add_node(subgraph, node_id, name, 'green', 'square', 'filled,bold')
+			if access in ('use', 'update'):
+				definition = self.locals.get(name, self.globals.get(name))
+				if definition is not None:
+					self.graph.add_edge(0, definition, node_id, direction='forward')
+
+		# Assignments in a function to a variable only defined at file scope are taken to be to that variable
+		for node_id, name, access in accesses:
+			if access == 'use':
+				continue
+			if self.function is None or (access != 'declare' and name not in self.locals and name in self.globals):
+				self.globals[name] = node_id
+			else:
+				self.locals[name] = node_id
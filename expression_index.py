@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+
+# Structural hashes of expression subtrees, and an on-disk index from each hash to where it occurs across a codebase
+
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+
+# Canonical text of larger subtrees is shortened, so that building it stays linear in the size of the expression
+MAX_TEXT = 200
+
+# Occurrences held before they are committed, bounding memory use for large files
+MAX_PENDING = 100000
+
+
+def expression_hashes(record):
+	# Compute a structural hash, canonical text and size for every subtree of an expression record, bottom-up. Record
+	# nodes are in pre-order, so walking them backwards reaches every child before its parent.
+	children = {}
+	results = {}
+	for node in reversed(record['nodes']):
+		node_children = children.pop(node['id'], [])
+		node_children.reverse()
+
+		digest = hashlib.blake2b(f"{node['kind']}\0{node['label']}".encode(), digest_size=16)
+		size = 1
+		for edge, (child_hash, _, child_size) in node_children:
+			digest.update(f"\0{edge}\0{child_hash}".encode())
+			size += child_size
+
+		label = str(node['label']).replace('\n', ' ')
+		if node_children:
+			text = '({} {})'.format(label, ' '.join(child_text for _, (_, child_text, _) in node_children))
+		else:
+			text = label
+		if len(text) > MAX_TEXT:
+			text = text[:MAX_TEXT - 3] + '...'
+
+		results[node['id']] = (digest.hexdigest(), text, size)
+		if node['parent'] is not None:
+			children.setdefault(node['parent'], []).append((node['edge'], results[node['id']]))
+	return results
+
+
+def duplicate_subtrees(nodes):
+	# Given (id, parent id, hash, size) for expression nodes in pre-order, find the repeats of subexpressions containing
+	# an operator after their first occurrence. Returns these and all their descendants, and the first occurrence to use
+	# in place of each repeat. Whole expressions are never dropped, but later repeats may be replaced by them.
+	first = {}
+	dropped = set()
+	redirects = {}
+	for node_id, parent_id, digest, size in nodes:
+		if parent_id in dropped:
+			dropped.add(node_id)
+		elif size > 1:
+			if parent_id is not None and digest in first:
+				dropped.add(node_id)
+				redirects[node_id] = first[digest]
+			else:
+				first.setdefault(digest, node_id)
+	return dropped, redirects
+
+
+class ExpressionHasher:
+	# Sink for extracted expression records, hashing them to add to an index and/or to collapse duplicated
+	# subexpressions in the expression graph being built
+	def __init__(self, index=None, collapse=False):
+		self.index = index
+		self.collapse = collapse
+		self.nodes = []
+
+	def __call__(self, record):
+		hashes = expression_hashes(record)
+		if self.index is not None:
+			self.index.add(record, hashes)
+		if self.collapse:
+			for node in record['nodes']:
+				digest, _, size = hashes[node['id']]
+				self.nodes.append((node['id'], node['parent'], digest, size))
+
+	def collapse_extraction(self, extraction, removed=()):
+		# Share duplicated subexpressions seen since the last call, other than any already removed from the graph
+		if not self.collapse:
+			return extraction
+		dropped, redirects = duplicate_subtrees([node for node in self.nodes if node[0] not in removed])
+		self.nodes = []
+		return extraction._replace(expressions=extraction.expressions.collapse(dropped, redirects))
+
+
+class ExpressionIndex:
+	def __init__(self, path):
+		# Several processes may add to the index at once, each waiting for the others' transactions to finish
+		self.connection = sqlite3.connect(path, timeout=300)
+		self.connection.execute('PRAGMA journal_mode=WAL')
+		with self.connection:
+			self.connection.execute('CREATE TABLE IF NOT EXISTS expressions '
+			                        '(hash TEXT PRIMARY KEY, text TEXT, size INTEGER)')
+			self.connection.execute('CREATE TABLE IF NOT EXISTS occurrences '
+			                        '(hash TEXT, source TEXT, file TEXT, line INTEGER, column INTEGER, kind TEXT, '
+			                        'root INTEGER)')
+			self.connection.execute('CREATE INDEX IF NOT EXISTS occurrences_hash ON occurrences (hash)')
+			self.connection.execute('CREATE INDEX IF NOT EXISTS occurrences_source ON occurrences (source)')
+		self.source = None
+		self.replace = False
+		self.expressions = []
+		self.occurrences = []
+
+	def begin(self, source_filename):
+		# Start (re-)indexing a source file, replacing anything previously recorded for it on the first commit
+		self.source = os.path.abspath(source_filename)
+		self.replace = True
+		self.expressions = []
+		self.occurrences = []
+
+	def add(self, record, hashes=None):
+		# Record every subtree of an expression that contains an operator, i.e. everything but single identifiers and
+		# constants, at the coordinate of the expression
+		if hashes is None:
+			hashes = expression_hashes(record)
+		for node in record['nodes']:
+			digest, text, size = hashes[node['id']]
+			if size > 1:
+				self.expressions.append((digest, text, size))
+				self.occurrences.append((digest, self.source, record['file'], record['line'], record['column'],
+				                         node['kind'], node['parent'] is None))
+		if len(self.occurrences) >= MAX_PENDING:
+			self.commit()
+
+	def commit(self):
+		# A file's expressions may be committed in several parts, e.g. as each shard is extracted
+		with self.connection:
+			if self.replace:
+				self.connection.execute('DELETE FROM occurrences WHERE source = ?', (self.source,))
+				self.replace = False
+			self.connection.executemany('INSERT OR IGNORE INTO expressions VALUES (?, ?, ?)', self.expressions)
+			self.connection.executemany('INSERT INTO occurrences VALUES (?, ?, ?, ?, ?, ?, ?)', self.occurrences)
+		self.expressions = []
+		self.occurrences = []
+
+	def duplicates(self, min_count=2, min_size=2, limit=100):
+		return self.connection.execute(
+			'SELECT o.hash, COUNT(*) AS count, e.size, e.text FROM occurrences o JOIN expressions e ON o.hash = e.hash '
+			'WHERE e.size >= ? GROUP BY o.hash HAVING count >= ? ORDER BY count * e.size DESC LIMIT ?',
+			(min_size, min_count, limit)).fetchall()
+
+	def occurrences_of(self, digest):
+		return self.connection.execute(
+			'SELECT source, file, line, column, kind, root FROM occurrences WHERE hash = ? ORDER BY file, line, column',
+			(digest,)).fetchall()
+
+	def close(self):
+		self.connection.close()
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Query an index of repeated expressions.')
+	parser.add_argument('index', help='index file, built with expressions.py --index')
+	parser.add_argument('-j', '--json', action='store_true', help='output JSON lines')
+	commands = parser.add_subparsers(dest='command', required=True)
+	duplicates = commands.add_parser('duplicates', help='list the most repeated expressions')
+	duplicates.add_argument('-m', '--min-count', type=int, default=2, help='minimum occurrences (default 2)')
+	duplicates.add_argument('-s', '--min-size', type=int, default=2, help='minimum nodes in expression (default 2)')
+	duplicates.add_argument('-n', '--limit', type=int, default=100, help='maximum expressions to list (default 100)')
+	occurrences = commands.add_parser('occurrences', help='list where an expression occurs')
+	occurrences.add_argument('hash')
+	args = parser.parse_args()
+
+	if not os.path.exists(args.index):
+		parser.error(f"index '{args.index}' does not exist")
+	index = ExpressionIndex(args.index)
+
+	if args.command == 'duplicates':
+		for digest, count, size, text in index.duplicates(args.min_count, args.min_size, args.limit):
+			if args.json:
+				print(json.dumps({'hash': digest, 'count': count, 'size': size, 'text': text}))
+			else:
+				print(f"{digest}\t{count}\t{size}\t{text}")
+	else:
+		for source, file, line, column, kind, root in index.occurrences_of(args.hash):
+			if args.json:
+				print(json.dumps({'source': source, 'file': file, 'line': line, 'column': column, 'kind': kind,
+				                  'root': bool(root)}))
+			else:
+				print(f"{file}:{line}:{column}\t{kind}{'' if root else ' (subexpression)'}")
+
+	index.close()
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())
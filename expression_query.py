@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+# Queries selecting which expressions to extract, evaluated on each expression's AST node as the walk reaches it, so
+# that unselected expressions are skipped before anything is built for them.
+#
+# A query is a list of terms that must all match, each 'key:pattern' and optionally negated with '!'. Patterns may give
+# several alternatives separated by '|', with '*' and '?' wildcards. For example, 'kind:Assignment target:d[]' selects
+# assignments to elements of d, and 'kind:Return function:main line:10-20' returns in main on lines 10 to 20.
+#
+#   kind      the expression's AST node type: Assignment, UnaryOp (increment or decrement), Decl or Return
+#   op        its operator: e.g. '=', '+=', '++' or 'p++' (postfix), '=' for declarations and 'return' for returns
+#   target    what it assigns, written without indices: e.g. 'x', 'd[]', 'p->next' or '*p'
+#   name      any identifier it uses or declares
+#   function  the function it is in (nothing matches at file scope)
+#   file      its source file, by full path or base name
+#   line      its line, a range 'N-M' (either end may be left open) or a single line 'N'
+
+import os
+import re
+
+KEYS = ('kind', 'op', 'target', 'name', 'function', 'file', 'line')
+
+
+def glob(pattern):
+	alternatives = []
+	for alternative in pattern.split('|'):
+		alternatives.append(''.join('.*' if c == '*' else '.' if c == '?' else re.escape(c) for c in alternative))
+	return re.compile('(?:{})\\Z'.format('|'.join(alternatives)))
+
+
+def line_range(pattern):
+	first, separator, last = pattern.partition('-')
+	if not (first or last) or not all(part.isdigit() for part in (first, last) if part):
+		raise ValueError(f"invalid line range '{pattern}', expected 'N', 'N-M', 'N-' or '-M'")
+	if not separator:
+		last = first
+	return int(first or 0), int(last) if last else None
+
+
+def lvalue_text(node):
+	# Write an lvalue as it would appear in C, without its array indices
+	kind = type(node).__name__
+	if kind == 'ID':
+		return node.name
+	if kind == 'ArrayRef':
+		return lvalue_text(node.name) + '[]'
+	if kind == 'StructRef':
+		return lvalue_text(node.name) + node.type + node.field.name
+	if kind == 'UnaryOp':
+		return node.op + lvalue_text(node.expr)
+	if kind == 'Cast':
+		return lvalue_text(node.expr)
+	return '?'
+
+
+def expression_operator(node):
+	kind = type(node).__name__
+	if kind in ('Assignment', 'UnaryOp'):
+		return node.op
+	if kind == 'Decl':
+		return '='
+	return 'return' if kind == 'Return' else None
+
+
+def expression_target(node):
+	kind = type(node).__name__
+	if kind == 'Assignment':
+		return lvalue_text(node.lvalue)
+	if kind == 'UnaryOp':
+		return lvalue_text(node.expr)
+	return node.name if kind == 'Decl' else None
+
+
+def identifiers(node):
+	# Every identifier used or declared in an expression, found without recursion
+	stack = [node]
+	while stack:
+		node = stack.pop()
+		kind = type(node).__name__
+		if kind == 'ID':
+			yield node.name
+		elif kind == 'Decl' and node.name is not None:
+			yield node.name
+		stack.extend(child for _, child in node.children())
+
+
+class Query:
+	def __init__(self, text):
+		self.text = text
+		self.terms = []
+		for term in text.split():
+			negated = term.startswith('!')
+			key, separator, pattern = term.lstrip('!').partition(':')
+			if key not in KEYS or not separator:
+				raise ValueError(f"invalid term '{term}', expected one of {', '.join(k + ':' for k in KEYS)}")
+			self.terms.append((key, negated, line_range(pattern) if key == 'line' else glob(pattern)))
+		if not self.terms:
+			raise ValueError('empty query')
+
+	def __repr__(self):
+		return f'Query({self.text!r})'
+
+	def matches(self, node, function):
+		for key, negated, test in self.terms:
+			if key == 'line':
+				first, last = test
+				matched = node.coord.line >= first and (last is None or node.coord.line <= last)
+			elif key == 'name':
+				matched = any(test.match(name) for name in identifiers(node))
+			elif key == 'file':
+				matched = test.match(node.coord.file) is not None or test.match(os.path.basename(node.coord.file))
+			else:
+				if key == 'kind':
+					value = type(node).__name__
+				elif key == 'op':
+					value = expression_operator(node)
+				elif key == 'target':
+					value = expression_target(node)
+				else:
+					value = function
+				matched = value is not None and test.match(value) is not None
+			if bool(matched) == negated:
+				return False
+		return True
+
+
+def selector(queries):
+	# A function selecting the expressions (given their AST node and the function they are in) matching any query
+	if not queries:
+		return None
+	return lambda node, function: any(query.matches(node, function) for query in queries)
@@ -1,221 +1,1344 @@
 #!/usr/bin/env python3
 
-import pycparser
-from pycparser import c_ast
-import pygraphviz as pgv
 import argparse
+import collections
+import contextlib
+import glob
+import json
+import os
+import shlex
+import sys
 
+from graph_ir import GraphIR, NullGraph
+from instrumentation import Instrumentation, reset_peak_memory
+from preprocess import PreprocessCache, preprocess
 
-def add_node(graph, node_id, node_label, parent_id=None, edge_label='', color='', invert=False, shape='', direction='', style='filled'):
-	if verbosity > 1:
-		print(node_id, node_label.replace('\n', ' '))
 
-	# Add node to graph
-	graph.add_node(node_id, fillcolor=color, label=node_label, shape=shape, style=style)
+Extraction = collections.namedtuple('Extraction', ['ast_graph', 'expressions'])
 
-	# Create edge to or from parent (if it exists), depending on inversion
-	if parent_id is not None:
-		if invert:
-			graph.add_edge(node_id, parent_id, label=edge_label, dir=direction)
+# How a kind of AST node is drawn: its colour (None to keep its parent's) and shape, whether it is wrapped in a solid or
+# dashed cluster in the AST graph, whether it starts an expression or is excluded from them, and functions giving its
+# expression graph label (None for the full AST label), or label when it starts an expression
+NodeRule = collections.namedtuple('NodeRule', ['color', 'shape', 'cluster', 'expression', 'label', 'start_label'],
+                                  defaults=[None, '', None, None, None, None])
+
+DEFAULT_RULE = NodeRule()
+
+INCREMENT_RULE = NodeRule('green', cluster='solid', expression='start', start_label=lambda node: node.op)
+UNARY_RULE = NodeRule('green', cluster='dashed')
+INITIALISER_RULE = NodeRule('green', cluster='solid', expression='start', start_label=lambda node: '=')
+DECLARATION_RULE = NodeRule('green', cluster='dashed')
+
+# Rules are keyed by node class name, so that pycparser is only imported when something is parsed
+NODE_RULES = {
+	# Colour assigment in green, and create expression around it
+	'Assignment': NodeRule('green', cluster='solid', expression='start', label=lambda node: node.op),
+	# Colour unary operator in green, and create new expression around it if increment or decrement
+	'UnaryOp': lambda node: INCREMENT_RULE if node.op in ('++', 'p++', '--', 'p--') else UNARY_RULE,
+	# Colour declaration in green, and create new expression around it if an initialiser
+	'Decl': lambda node: INITIALISER_RULE if node.init is not None else DECLARATION_RULE,
+	# Colour return in red, and create new expression around it
+	'Return': NodeRule('red', 'square', cluster='solid', expression='start', label=lambda node: '\\<ret\\>'),
+	# Colour binary operator in yellow
+	'BinaryOp': NodeRule('yellow', label=lambda node: node.op),
+	# Colour constant operator in pink
+	'Constant': NodeRule('pink', 'square', label=lambda node: node.value),
+	# Colour identifier in light blue
+	'ID': NodeRule('lightblue', 'square', label=lambda node: node.name),
+	# Colour type declarations in light blue
+	'TypeDecl': NodeRule('lightblue', 'square', label=lambda node: node.declname),
+	# Don't include type identifiers in expression graphs
+	'IdentifierType': NodeRule(expression='exclude'),
+}
+
+# Rules for further expression node types, which are otherwise shown with their full AST labels
+EXTENDED_NODE_RULES = {
+	'FuncCall': NodeRule('orange', label=lambda node: '{}()'.format(getattr(node.name, 'name', 'call'))),
+	'ArrayRef': NodeRule('yellow', label=lambda node: '[]'),
+	'Cast': NodeRule('yellow', label=lambda node: 'cast'),
+	'TernaryOp': NodeRule('yellow', label=lambda node: '?:'),
+	'StructRef': NodeRule('yellow', label=lambda node: node.type + node.field.name),
+}
+
+# A job's source may already have been preprocessed, as its text (or the error preprocessing it) and the
+# instrumentation of doing so
+Job = collections.namedtuple('Job', ['source_filename', 'cpp_args', 'ast_output', 'expressions_output',
+                                     'records_output', 'options', 'data_flow_output', 'store_output', 'preprocessed'],
+                             defaults=[None, None, None])
+
+# In a pipeline's extraction worker processes, the queue that graphs are sent on to be rendered
+render_queue = None
+
+
+class ExpressionExtractor:
+	def __init__(self, verbosity=0, graphs=True, sink=None, rules=None, select=None, control_flow=False):
+		# Graphs can be disabled when only the records passed to sink (one per expression, as it is completed) are needed.
+		# Rules for additional node types, or replacing the default ones, map node classes (or their names) to a NodeRule
+		# or a function returning one for a given node. Select, given an expression's AST node and the function it is
+		# in, limits extraction to the expressions it returns true for (see expression_query.py). Control flow groups
+		# expressions into basic blocks joined by the branches and loops between them, rather than one left-right chain.
+		from pycparser import c_ast
+
+		self.verbosity = verbosity
+		self.graphs = graphs
+		self.sink = sink
+		rules = NODE_RULES if rules is None else {**NODE_RULES, **rules}
+		self.rules = {getattr(c_ast, key) if isinstance(key, str) else key: rule for key, rule in rules.items()}
+		self.select = select
+		self.control_flow = control_flow
+		self.flow = None
+		self.labels = graphs or verbosity > 1
+		self.func_def = c_ast.FuncDef
+		self.counter = 0
+		self.function = None
+		self.ast_graph = None
+		self.expressions = None
+		self.record = None
+
+	def extract(self, ast):
+		return self.extract_nodes([ast])
+
+	def extract_nodes(self, nodes):
+		# Create graphs for the AST and expressions, with expressions ordered left-right as in the source file (within
+		# each basic block when following control flow, whose loops need edges both ways between blocks)
+		if self.graphs and self.control_flow:
+			from control_flow import ControlFlow
+
+			self.ast_graph = GraphIR()
+			self.expressions = GraphIR(ordered=True, newrank='true', strict=False)
+			self.flow = ControlFlow(self.expressions)
+		elif self.graphs:
+			self.ast_graph = GraphIR()
+			self.expressions = GraphIR(ordered=True, newrank='true')
 		else:
-			graph.add_edge(parent_id, node_id, label=edge_label, dir=direction)
+			self.ast_graph = NullGraph()
+			self.expressions = NullGraph()
 
+		# Walk the AST for expressions
+		self.counter = 0
+		for node in nodes:
+			self.walk(node)
 
-def add_order(node_id):
-	global order_id
-	ordering.add_edge(order_id, node_id, style='invis')
-	order_id = node_id
+		extraction = Extraction(self.ast_graph, self.expressions)
+		self.ast_graph = None
+		self.expressions = None
+		self.flow = None
+		return extraction
 
+	def extract_declaration(self, node, index):
+		# Walk one external declaration of a file without building graphs, numbering its nodes as if it were a child of
+		# the file's FileAST (node 1), so that walking each declaration in turn gives the same records as extract()
+		if index == 0:
+			self.counter = 1
+		self.ast_graph = NullGraph()
+		self.expressions = NullGraph()
+		self.walk(node, 1, f'ext[{index}]')
+		self.ast_graph = None
+		self.expressions = None
 
-def parse_node(graph, expression, node, parent_id=None, edge_label='', color='white'):
-	global counter
-	global order_id
-	counter += 1
+	def add_node(self, graph, subgraph, node_id, node_label, parent_id=None, edge_label='', color='', invert=False, shape='', direction='', style='filled'):
+		if self.verbosity > 1:
+			print(node_id, node_label.replace('\n', ' '))
 
-	# Set up default options for node
-	node_id = str(counter)
-	node_label = type(node).__name__
-	subgraph = graph
-	e = expression
-	shape = ''
-	invert = False
-	expression_parent_id = parent_id
-	ast_node_style = 'filled'
-	expression_node_style = 'filled'
-	coordinate = str(node.coord).split('/')[-1]
+		# Add node to graph
+		graph.add_node(subgraph, node_id, node_label, color, shape, style)
 
-	# Add any attributes to the node label (e.g. name, op, type, etc.)
-	for attr in node.attr_names:
-		val = getattr(node, attr)
-		node_label += '\n{}: {}'.format(attr, val)
-
-	expression_label = node_label
-
-	# Deal with various different node types by changing the defaults and creating expressions
-	if isinstance(node, c_ast.Assignment):
-		# Colour assigment in green, and create expression around it
-		color = 'green'
-		subgraph = graph.subgraph(name='cluster' + node_id, label=coordinate)
-		if e is None:
-			e = expressions
-			expression_parent_id = None
-			add_order(node_id)
-			e = e.subgraph(name='cluster' + node_id, label=coordinate)
-			expression_node_style += ',bold'
-		expression_label = node.op
-	elif isinstance(node, c_ast.UnaryOp):
-		# Colour unary operator in green, and create new expression around it if increment or decrement
-		color = 'green'
-		if node.op in ('++', 'p++', '--', 'p--'):
-			subgraph = graph.subgraph(name='cluster' + node_id, label=coordinate)
-			if e is None:
-				e = expressions
-				expression_parent_id = None
-				add_order(node_id)
-				e = e.subgraph(name='cluster' + node_id, label=coordinate)
-				expression_node_style += ',bold'
-				expression_label = node.op
+		# Create edge to or from parent (if it exists), depending on inversion
+		if parent_id is not None:
+			if invert:
+				graph.add_edge(subgraph, node_id, parent_id, edge_label, direction)
+			else:
+				graph.add_edge(subgraph, parent_id, node_id, edge_label, direction)
+
+	def walk(self, node, parent_id=None, edge_label=''):
+		if self.select is None:
+			self.parse_node(0, None, node, parent_id, edge_label)
 		else:
-			subgraph = graph.subgraph(name='cluster' + node_id, style="dashed", label=coordinate)
-	elif isinstance(node, c_ast.Decl):
-		# Colour declaration in green, and create new expression around it if an initialiser
-		color = 'green'
-		if node.init is not None:
-			subgraph = graph.subgraph(name='cluster' + node_id, label=coordinate)
-			if e is None:
-				e = expressions
+			self.select_expressions(node, parent_id, edge_label)
+
+	def select_expressions(self, node, parent_id, edge_label):
+		# Walk the AST only looking for expressions, and extract those selected as usual (but without the AST around
+		# them). Nothing else is labelled or added to the graphs, and unselected expressions are just counted, so that
+		# nodes keep the ids they have when extracting everything.
+		stack = [(node, parent_id, edge_label)]
+		while stack:
+			node, parent_id, edge_label = stack.pop()
+			if parent_id is None or (parent_id == 1 and edge_label.startswith('ext[')):
+				self.function = node.decl.name if isinstance(node, self.func_def) else None
+
+			rule = self.rules.get(type(node), DEFAULT_RULE)
+			if not isinstance(rule, NodeRule):
+				rule = rule(node)
+			if rule.cluster is not None and rule.expression == 'start':
+				if self.select(node, self.function):
+					self.parse_node(0, None, node, None, edge_label)
+				else:
+					skipped = [node]
+					while skipped:
+						self.counter += 1
+						skipped.extend(child for _, child in skipped.pop().children())
+				continue
+
+			self.counter += 1
+			node_id = self.counter
+			for child_name, child in reversed(node.children()):
+				stack.append((child, node_id, child_name))
+
+	def parse_node(self, graph, expression, node, parent_id=None, edge_label='', color='white'):
+		# Walk the AST with an explicit stack rather than recursion, so deeply nested expressions (e.g. long chains of
+		# binary operators) are not limited by Python's recursion depth. Each node is visited on the way down, adding it
+		# to any expression graph, and finished on the way back up, adding it to the AST graph after its children.
+		stack = [(False, (graph, expression, node, parent_id, edge_label, color))]
+		while stack:
+			finished, frame = stack.pop()
+			if finished:
+				graph, node_id, node_label, parent_id, edge_label, color, ast_node_style = frame
+				self.add_node(self.ast_graph, graph, node_id, node_label, parent_id, edge_label, color, style=ast_node_style)
+				if self.record is not None and self.record['id'] == node_id:
+					self.sink(self.record)
+					self.record = None
+				if self.flow is not None:
+					self.flow.leave(node_id)
+				continue
+
+			graph, expression, node, parent_id, edge_label, color = frame
+			subgraph, e, node_id, node_label, color, ast_node_style = self.visit_node(*frame)
+			stack.append((True, (graph, node_id, node_label, parent_id, edge_label, color, ast_node_style)))
+
+			# Push the children of this node in reverse, so they are visited in order
+			for child_name, child in reversed(node.children()):
+				stack.append((False, (subgraph, e, child, node_id, child_name, color)))
+
+	def start_expression(self, node, node_id, coordinate):
+		self.expressions.add_root(node_id, self.function)
+		if self.sink is not None:
+			self.record = {'id': node_id, 'kind': type(node).__name__, 'file': node.coord.file, 'line': node.coord.line,
+			               'column': node.coord.column, 'coord': coordinate, 'function': self.function, 'nodes': [],
+			               'operands': []}
+		block = self.flow.block() if self.flow is not None else 0
+		return self.expressions.add_subgraph(block, f'cluster{node_id}', label=coordinate)
+
+	def add_record_node(self, node, node_id, label, parent_id, edge_label):
+		# Expression trees are recorded as a flat list of nodes linked to their parents, so they can be arbitrarily deep
+		kind = type(node).__name__
+		if kind == 'Return':
+			label = 'return'
+		record_node = {'id': node_id, 'kind': kind, 'label': label, 'parent': parent_id,
+		               'edge': edge_label if parent_id is not None else None}
+		# Declarations and casts also record the type they are declared with or cast to
+		if kind == 'Decl':
+			record_node['type'] = type_name(node.type)
+		elif kind == 'Cast':
+			record_node['type'] = type_name(node.to_type.type)
+		self.record['nodes'].append(record_node)
+		if kind in ('ID', 'Constant'):
+			self.record['operands'].append(label)
+
+	def visit_node(self, graph, expression, node, parent_id, edge_label, color):
+		self.counter += 1
+
+		# Expressions belong to the function they are in, if any, which can only be an external declaration (a child of
+		# the FileAST, always node 1, or a top-level node when walking declarations by themselves). Selected expressions
+		# are walked from their own node, and the function they are in is already known.
+		if (parent_id is None or (parent_id == 1 and edge_label.startswith('ext['))) and self.select is None:
+			self.function = node.decl.name if isinstance(node, self.func_def) else None
+
+		# Look up how this kind of node is drawn, which may depend on the node itself (e.g. its operator)
+		rule = self.rules.get(type(node), DEFAULT_RULE)
+		if not isinstance(rule, NodeRule):
+			rule = rule(node)
+
+		# Set up default options for node, only formatting the full label if something will use it
+		node_id = self.counter
+		if self.flow is not None and expression is None:
+			self.flow.enter(node, node_id, parent_id, edge_label)
+		node_label = ast_label(node) if self.labels else None
+		subgraph = graph
+		e = expression
+		expression_parent_id = parent_id
+		ast_node_style = 'filled'
+		expression_node_style = 'filled'
+		expression_label = rule.label(node) if rule.label is not None else None
+		if rule.color is not None:
+			color = rule.color
+
+		# Clusters group a node and its children in the AST graph, and some nodes create a new expression around them
+		if rule.cluster is not None:
+			coordinate = str(node.coord).split('/')[-1]
+			if rule.cluster == 'dashed':
+				subgraph = self.ast_graph.add_subgraph(graph, f'cluster{node_id}', style="dashed", label=coordinate)
+			else:
+				subgraph = self.ast_graph.add_subgraph(graph, f'cluster{node_id}', label=coordinate)
+			if rule.expression == 'start' and e is None:
 				expression_parent_id = None
-				add_order(node_id)
-				e = e.subgraph(name='cluster' + node_id, label=coordinate)
+				e = self.start_expression(node, node_id, coordinate)
 				expression_node_style += ',bold'
-				expression_label = '='
+				if rule.start_label is not None:
+					expression_label = rule.start_label(node)
+		elif rule.expression == 'exclude':
+			e = None
+
+		# Invert the direction of lvalue edges to show them opposite (above) rvalues in expressions
+		invert = edge_label in ('lvalue', 'type')
+
+		# If parsing a node that is part of an expression, add it to the current expression subgraph
+		if e is not None:
+			if expression_label is None:
+				expression_label = node_label if node_label is not None else ast_label(node)
+			self.add_node(self.expressions, e, node_id, expression_label, expression_parent_id, '', color, invert=invert,
+			              shape=rule.shape, direction='back', style=expression_node_style)
+			if self.record is not None:
+				self.add_record_node(node, node_id, expression_label, expression_parent_id, edge_label)
 		else:
-			subgraph = graph.subgraph(name='cluster' + node_id, style="dashed", label=coordinate)
-	elif isinstance(node, c_ast.Return):
-		# Colour return in red, and create new expression around it
-		color = 'red'
-		subgraph = graph.subgraph(name='cluster' + node_id, label=coordinate)
-		if e is None:
-			e = expressions
-			expression_parent_id = None
-			add_order(node_id)
-			e = e.subgraph(name='cluster' + node_id, label=coordinate)
-			expression_node_style += ',bold'
-		shape = 'square'
-		expression_label = '\\<ret\\>'
-	elif isinstance(node, c_ast.BinaryOp):
-		# Colour binary operator in yellow
-		color = 'yellow'
-		expression_label = node.op
-	elif isinstance(node, c_ast.Constant):
-		# Colour constant operator in pink
-		shape = 'square'
-		color = 'pink'
-		expression_label = node.value
-	elif isinstance(node, c_ast.ID):
-		# Colour identifier in light blue
-		shape = 'square'
-		color = 'lightblue'
-		expression_label = node.name
-	elif isinstance(node, c_ast.TypeDecl):
-		# Colour type declarations in light blue
-		shape = 'square'
-		color = 'lightblue'
-		if node.declname is not None:
-			expression_label = node.declname
-	elif isinstance(node, c_ast.IdentifierType):
-		# Don't include type identifiers in expression graphs
-		e = None
-
-	# Invert the direction of lvalue edges to show them opposite (above) rvalues in expressions
-	if edge_label in ('lvalue', 'type'):
-		invert = True
-
-	# If parsing a node that is part of an expression, add it to the current expression subgraph
-	if e is not None:
-		add_node(e, node_id, expression_label, expression_parent_id, '', color, invert=invert, shape=shape,
-		         direction='back', style=expression_node_style)
-	else:
-		ast_node_style += ',dashed'
-
-	# Recursively parse the children of this node
-	for child in node.children():
-		parse_node(subgraph, e, child[1], node_id, child[0], color)
-
-	# Add this node to the AST graph (or subgraph)
-	add_node(graph, node_id, node_label, parent_id, edge_label, color, style=ast_node_style)
-
-
-parser = argparse.ArgumentParser(description='Extract expressions from C source.')
-parser.add_argument('source_file')
-parser.add_argument('-c', '--cpp', metavar='cpp_path', type=str, default='cpp',
-                    help="path to C preprocessor executable (default 'cpp')")
-parser.add_argument('-a', '--cppargs', metavar='cpp_args', type=str, default='',
-                    help="additional C preprocessor arguments (default none)")
-parser.add_argument('-t', '--ast', metavar='output_file', help='output AST graph to this file')
-parser.add_argument('-e', '--expressions', metavar='output_file', help='output expression graphs to this file')
-parser.add_argument('-p', '--png', action='store_true', help='output PNG file')
-parser.add_argument('-d', '--dot', action='store_true', help='output DOT file')
-parser.add_argument('-v', '--verbose', action='count', default=0, help='verbose output')
-args = parser.parse_args()
-
-source_filename = args.source_file
-cpp_path = args.cpp
-cpp_args = args.cppargs
-ast_output = args.ast
-expressions_output = args.expressions
-output_png = args.png
-output_dot = args.dot
-verbosity = args.verbose
-
-if verbosity > 0:
-	print(f"Parsing file '{source_filename}'...")
-
-ast = pycparser.parse_file(source_filename, use_cpp=True, cpp_path=cpp_path, cpp_args=cpp_args)
-
-if verbosity > 0:
-	print(f"Constructing graphs...")
-
-# Create graph for expressions
-ast_graph = pgv.AGraph()
-expressions = pgv.AGraph(newrank='true')
-
-# Set up vertical alignment and deterministic left-right ordering of source file statements
-expressions.add_node('rank1', label='', style='invis', width=0)
-expressions.add_node('rank2', label='', style='invis', width=0)
-expressions.add_edge('rank1', 'rank2', style='invis')
-ordering = expressions.subgraph(rank='same', rankdir='LR')
-order_id = 'rank2'
-
-# Recursively parse the AST for expressions
-counter = 0
-parse_node(ast_graph, None, ast)
-
-# Add final node on right-hand-side to complete left-right ordering
-expressions.add_node('end', label='', style='invis', width=0)
-ordering.add_edge(order_id, 'end', style='invis')
-
-if ast_output is not None:
-	ast_graph.layout('dot')
-	if output_dot:
+			ast_node_style += ',dashed'
+
+		return subgraph, e, node_id, node_label, color, ast_node_style
+
+
+def ast_label(node):
+	# Label a node with its type and any attributes (e.g. name, op, type, etc.)
+	label = type(node).__name__
+	for attr in node.attr_names:
+		label += '\n{}: {}'.format(attr, getattr(node, attr))
+	return label
+
+
+def type_name(node):
+	# Name a declared type as it would be written without its declarator, e.g. 'unsigned int' or 'struct point *'
+	kind = type(node).__name__
+	if kind == 'TypeDecl':
+		if type(node.type).__name__ == 'IdentifierType':
+			return ' '.join(node.type.names)
+		return '{} {}'.format(type(node.type).__name__.lower(), node.type.name)
+	if kind == 'PtrDecl':
+		return type_name(node.type) + ' *'
+	if kind == 'ArrayDecl':
+		return type_name(node.type) + '[]'
+	if kind == 'FuncDecl':
+		return type_name(node.type) + '()'
+	return kind
+
+
+def shard_nodes(declarations, shard):
+	# Split a file's external declarations into either one shard per function (grouping together the declarations
+	# between functions), or shards of a fixed number of declarations
+	from pycparser import c_ast
+
+	group = []
+	for node in declarations:
+		if shard == 'function' and isinstance(node, c_ast.FuncDef):
+			if group:
+				yield group
+				group = []
+			yield [node]
+		else:
+			group.append(node)
+			if group and len(group) == shard:
+				yield group
+				group = []
+	if group:
+		yield group
+
+
+def shard_name(nodes, index):
+	from pycparser import c_ast
+
+	if len(nodes) == 1 and isinstance(nodes[0], c_ast.FuncDef):
+		return f'{index}.{nodes[0].decl.name}'
+	return f'{index}.declarations'
+
+
+def preprocess_source(source_filename, cpp_path='cpp', cpp_args='', instrumentation=None, fast=False, cache=None):
+	# The fast path skips running cpp for files that need no preprocessing beyond removing comments, and the cache for
+	# files whose headers are unchanged since they were last preprocessed
+	if instrumentation is None:
+		instrumentation = Instrumentation()
+	with instrumentation.stage('cpp'):
+		text, method = preprocess(source_filename, cpp_path, cpp_args, fast, cache)
+	if method == 'fast':
+		instrumentation.count('fast_preprocess')
+	elif method == 'cache':
+		instrumentation.count('cpp_cache_hits')
+	return text
+
+
+def parse(source_filename, cpp_path='cpp', cpp_args='', cache=None, instrumentation=None, fast=False, cpp_cache=None,
+          text=None):
+	# Source that has already been preprocessed (e.g. in a separate stage) can be given as text
+	if instrumentation is None:
+		instrumentation = Instrumentation()
+	if text is None:
+		text = preprocess_source(source_filename, cpp_path, cpp_args, instrumentation, fast, cpp_cache)
+
+	# Parsing is skipped when the preprocessed source has been parsed before
+	if cache is not None:
+		with instrumentation.stage('cache'):
+			key = cache.key(text, source_filename, cpp_args)
+			ast = cache.load(key)
+		if ast is not None:
+			instrumentation.count('cache_hits')
+			return ast
+
+	with instrumentation.stage('parse'):
+		import pycparser
+		ast = pycparser.CParser().parse(text, source_filename)
+
+	if cache is not None:
+		with instrumentation.stage('cache'):
+			cache.store(key, ast)
+	return ast
+
+
+def parse_declarations(source_filename, cpp_path='cpp', cpp_args='', instrumentation=None, fast=False, cpp_cache=None,
+                       text=None):
+	# Preprocess a file, then parse it one external declaration at a time as the declarations are consumed, rather than
+	# building a FileAST, so that declarations can be processed and dropped one at a time. The parser keeps tokens for
+	# backtracking, but never across declarations, so they are also dropped as each is finished.
+	import pycparser
+	try:
+		from pycparser.c_parser import _TokenStream
+	except ImportError:
+		_TokenStream = None
+
+	if instrumentation is None:
+		instrumentation = Instrumentation()
+
+	if text is None:
+		text = preprocess_source(source_filename, cpp_path, cpp_args, instrumentation, fast, cpp_cache)
+
+	# Only pycparser 3's recursive descent parser can be stopped between declarations, through its private methods and
+	# token stream, so any other version parses the whole file at once
+	parser = pycparser.CParser()
+	tokens = None
+	streaming = (_TokenStream is not None and hasattr(getattr(parser, 'clex', None), 'input')
+	             and all(hasattr(parser, method) for method in ('_peek', '_parse_external_declaration')))
+	if streaming:
+		parser.clex.input(text, source_filename)
+		tokens = _TokenStream(parser.clex)
+		if not (hasattr(tokens, '_buffer') and hasattr(tokens, '_index')):
+			tokens = None
+	if tokens is None:
+		print(f"pycparser {pycparser.__version__} cannot parse one declaration at a time, parsing all of "
+		      f"'{source_filename}' at once", file=sys.stderr)
+		with instrumentation.stage('parse'):
+			ast = pycparser.CParser().parse(text, source_filename)
+		del text
+		yield from ast.ext
+		return
+	parser._tokens = tokens
+	del text
+	while True:
+		with instrumentation.stage('parse'):
+			if parser._peek() is None:
+				return
+			declarations = parser._parse_external_declaration()
+			del tokens._buffer[:tokens._index]
+			tokens._index = 0
+		yield from declarations
+
+
+def layout_engine(nodes, options):
+	# Fall back to a faster layout engine (or none at all) for graphs too large to lay out with the usual one
+	if options.max_layout_nodes > 0 and nodes > options.max_layout_nodes:
+		return options.large_layout
+	return options.layout
+
+
+def render(graph, output, description, dot=False, png=False, verbosity=0, engine='dot', instrumentation=None):
+	if instrumentation is None:
+		instrumentation = Instrumentation()
+
+	# DOT output is written without positions if there is no layout engine, but PNG output always needs one
+	if engine != 'none':
+		if verbosity > 0 and engine != 'dot':
+			print(f"Laying out {description} with '{engine}'...")
+		with instrumentation.stage('layout'):
+			graph.layout(engine)
+	elif png:
+		print(f"Not outputting {description} to '{output}.png' without a layout", file=sys.stderr)
+		png = False
+
+	if dot:
+		if verbosity > 0:
+			print(f"Outputting {description} to '{output}.dot'...")
+		with instrumentation.stage('write'):
+			graph.write(output + '.dot')
+	if png:
 		if verbosity > 0:
-			print(f"Outputting AST graph to '{ast_output}.dot'...")
-		ast_graph.write(ast_output + '.dot')
-	if output_png:
+			print(f"Outputting {description} to '{output}.png'...")
+		with instrumentation.stage('draw'):
+			graph.draw(output + '.png')
+
+
+def write_records(extractor_options, ast, records_output, instrumentation=None, sink=None):
+	# Stream one JSON record per expression, to a file name or an already open file, also passing them to any sink
+	# (which may add to them) before they are written
+	if instrumentation is None:
+		instrumentation = Instrumentation()
+	f = open(records_output, 'w') if isinstance(records_output, str) else records_output
+	try:
+		def write_record(record):
+			instrumentation.count('expressions')
+			if sink is not None:
+				sink(record)
+			f.write(json.dumps(record) + '\n')
+
+		extractor = ExpressionExtractor(**extractor_options, graphs=False, sink=write_record)
+		if type(ast).__name__ == 'FileAST':
+			with instrumentation.stage('walk'):
+				extractor.extract(ast)
+		else:
+			# Otherwise the AST is a stream of external declarations, each walked as it is parsed
+			for index, node in enumerate(ast):
+				with instrumentation.stage('walk'):
+					extractor.extract_declaration(node, index)
+		instrumentation.count('ast_nodes', extractor.counter)
+	finally:
+		if f is not records_output:
+			f.close()
+
+
+def extractor_options(options):
+	select = None
+	if options.select:
+		from expression_query import selector
+		select = selector(options.select)
+	return {'verbosity': options.verbose, 'rules': EXTENDED_NODE_RULES if options.extended else None, 'select': select,
+	        'control_flow': options.control_flow}
+
+
+def process_file(source_filename, cpp_args, ast_output, expressions_output, options, records_output=None,
+                 instrumentation=None, render=None, data_flow_output=None, preprocessed=None, store_output=None):
+	if instrumentation is None:
+		instrumentation = Instrumentation()
+
+	# Keep status messages out of the record stream when writing records
+	if options.format == 'jsonl':
+		if records_output == '-':
+			records_output = sys.stdout
+		with contextlib.redirect_stdout(sys.stderr):
+			process_source(source_filename, cpp_args, ast_output, expressions_output, options, records_output,
+			               instrumentation, render, data_flow_output, preprocessed, store_output)
+	else:
+		process_source(source_filename, cpp_args, ast_output, expressions_output, options, records_output,
+		               instrumentation, render, data_flow_output, preprocessed, store_output)
+	return instrumentation
+
+
+def process_source(source_filename, cpp_args, ast_output, expressions_output, options, records_output,
+                   instrumentation, render=None, data_flow_output=None, preprocessed=None, store_output=None):
+	verbosity = options.verbose
+
+	if verbosity > 0:
+		print(f"Parsing file '{source_filename}'...")
+
+	# With low memory use, external declarations are parsed as they are processed, never holding the whole AST
+	cpp_cache = PreprocessCache(options.cache) if options.cache is not None else None
+	if options.low_memory:
+		ast = parse_declarations(source_filename, options.cpp, cpp_args, instrumentation, options.fast, cpp_cache,
+		                         preprocessed)
+	else:
+		cache = None
+		if options.cache is not None:
+			from ast_cache import ASTCache
+			cache = ASTCache(options.cache, options.cache_size * 1024 * 1024)
+		ast = parse(source_filename, options.cpp, cpp_args, cache, instrumentation, options.fast, cpp_cache,
+		            preprocessed)
+
+	# Expressions are hashed as they are extracted when adding them to an index or sharing duplicates in graphs
+	hasher = None
+	if options.index is not None or options.share_duplicates:
+		from expression_index import ExpressionHasher, ExpressionIndex
+
+		index = None
+		if options.index is not None:
+			index = ExpressionIndex(options.index)
+			index.begin(source_filename)
+		hasher = ExpressionHasher(index, options.share_duplicates and options.format != 'jsonl')
+
+	try:
+		extract_source(source_filename, ast, ast_output, expressions_output, options, records_output, instrumentation,
+		               hasher, render, data_flow_output, store_output)
+	finally:
+		if hasher is not None and hasher.index is not None:
+			hasher.index.close()
+
+
+def extract_source(source_filename, ast, ast_output, expressions_output, options, records_output, instrumentation,
+                   hasher, render=None, data_flow_output=None, store_output=None):
+	verbosity = options.verbose
+
+	# Constant subexpressions are evaluated as they are extracted, adding their values to records, and collapsed into
+	# single nodes in graphs
+	folder = None
+	if options.fold:
+		from constant_folding import ConstantFolder
+		folder = ConstantFolder(options.format != 'jsonl')
+
+	if options.format == 'jsonl':
 		if verbosity > 0:
-			print(f"Outputting AST graph to '{ast_output}.png'...")
-		ast_graph.draw(ast_output + '.png')
+			print(f"Outputting expression records to '{getattr(records_output, 'name', records_output)}'...")
+		write_records(extractor_options(options), ast, records_output, instrumentation, combine_sinks(folder, hasher))
+		if hasher is not None and hasher.index is not None:
+			with instrumentation.stage('index'):
+				hasher.index.commit()
+		return
+
+	if verbosity > 0:
+		print(f"Constructing graphs...")
+
+	# The data-flow graph is built from expression records as they are extracted, alongside any hashing of them
+	data_flow = None
+	if data_flow_output is not None:
+		from data_flow import DataFlow
+		data_flow = DataFlow()
 
-if expressions_output is not None:
-	expressions.layout('dot')
-	if output_dot:
+	# Extracted graphs are also written to a binary store as they are produced, which is only put in place once complete
+	store = None
+	if store_output is not None:
+		from extraction_store import StoreWriter
 		if verbosity > 0:
-			print(f"Outputting expression graphs to '{expressions_output}.dot'...")
-		expressions.write(expressions_output + '.dot')
-	if output_png:
+			print(f"Outputting extracted graphs to store '{store_output}'...")
+		store = StoreWriter(store_output)
+
+	extractor = ExpressionExtractor(**extractor_options(options), sink=combine_sinks(folder, hasher, data_flow))
+	tasks = []
+	try:
+		if options.shard is None:
+			with instrumentation.stage('walk'):
+				extraction = extractor.extract(ast)
+			count_extraction(instrumentation, extractor, extraction)
+			extraction = collapse_extraction(instrumentation, extraction, folder, hasher)
+			if store is not None:
+				with instrumentation.stage('store'):
+					store.add(os.path.basename(source_filename), extraction)
+			if ast_output is not None:
+				tasks.append((extraction.ast_graph, ast_output, 'AST graph', options))
+			if expressions_output is not None:
+				tasks.append((extraction.expressions, expressions_output, 'expression graphs', options))
+			if data_flow is not None:
+				tasks.append((count_data_flow(instrumentation, data_flow.take()), data_flow_output, 'data-flow graph',
+				              options))
+		else:
+			# Shards are rendered as they are extracted, and with low memory use, parsed as they are extracted too
+			tasks = shard_tasks(extractor, ast if options.low_memory else ast.ext, source_filename, ast_output,
+			                    expressions_output, options, instrumentation, hasher, data_flow_output, data_flow,
+			                    folder, store)
+
+		render_tasks(tasks, options, instrumentation, render)
+	except BaseException:
+		if store is not None:
+			store.discard()
+		raise
+	if store is not None:
+		store.close()
+
+	if hasher is not None and hasher.index is not None:
+		with instrumentation.stage('index'):
+			hasher.index.commit()
+
+
+def render_tasks(tasks, options, instrumentation, render=None):
+	# Render graphs as they are produced, or pass them to a render callback (e.g. queueing them for a separate pool of
+	# render workers). Graphs are laid out independently, so are rendered in parallel worker processes when there are
+	# several, with at most twice as many in flight as workers: producing more graphs (and so extracting or parsing
+	# more) waits for rendering to catch up.
+	workers = job_count(options)
+	if render is not None:
+		for task in tasks:
+			instrumentation.count('graphs')
+			render(task)
+	elif workers > 1:
+		import concurrent.futures
+
+		with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+			pending = set()
+			for task in tasks:
+				instrumentation.count('graphs')
+				if len(pending) >= workers * 2:
+					done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+					for future in done:
+						instrumentation.merge(future.result())
+				pending.add(executor.submit(render_task, task))
+			for future in concurrent.futures.as_completed(pending):
+				instrumentation.merge(future.result())
+	else:
+		for task in tasks:
+			instrumentation.count('graphs')
+			render_task(task, instrumentation)
+
+
+def combine_sinks(*sinks):
+	# Pass each expression record to several sinks, ignoring any that are None
+	sinks = [sink for sink in sinks if sink is not None]
+	if len(sinks) < 2:
+		return sinks[0] if sinks else None
+
+	def sink(record):
+		for each in sinks:
+			each(record)
+	return sink
+
+
+def collapse_extraction(instrumentation, extraction, folder, hasher):
+	# Fold constant subexpressions into their values, then share duplicates among the subexpressions left
+	removed = set()
+	if folder is not None:
+		extraction, removed = folder.collapse_extraction(extraction)
+		instrumentation.count('folded_nodes', len(removed))
+	if hasher is not None:
+		extraction = hasher.collapse_extraction(extraction, removed)
+	return extraction
+
+
+def count_data_flow(instrumentation, graph):
+	instrumentation.count('def_use_edges', len(graph.edge_tails))
+	return graph
+
+
+def count_extraction(instrumentation, extractor, extraction):
+	instrumentation.count('ast_nodes', extractor.counter)
+	instrumentation.count('expressions', len(extraction.expressions.roots))
+	instrumentation.count('expression_nodes', len(extraction.expressions))
+	for graph in extraction:
+		instrumentation.count('clusters', len(graph.subgraph_names) - 1)
+		instrumentation.count('edges', len(graph.edge_tails))
+
+
+def shard_tasks(extractor, declarations, source_filename, ast_output, expressions_output, options, instrumentation,
+                hasher, data_flow_output=None, data_flow=None, folder=None, store=None):
+	# Yield tasks to write each shard's graphs to separate files, listed in an index alongside them. When incremental,
+	# shards whose content hash matches one in the previous index reuse its files rather than being extracted and
+	# rendered again. Shards are also added to any store as parts, copied from the previous store when reused.
+	verbosity = options.verbose
+	index_output = next((output for output in (expressions_output, ast_output, data_flow_output,
+	                                           store.path if store is not None else None) if output is not None), None)
+	outputs = [(key, output) for key, output in (('ast', ast_output), ('expressions', expressions_output),
+	                                             ('data_flow', data_flow_output)) if output is not None]
+	extensions = [extension for extension, wanted in (('.dot', options.dot), ('.png', options.png),
+	                                                  ('.html', options.html)) if wanted]
+	settings = (repr(sorted(key for key, _ in outputs)), repr(extensions), options.layout, options.large_layout,
+	            str(options.max_layout_nodes), str(options.extended), str(options.share_duplicates), str(options.fold),
+	            repr(options.select), str(options.control_flow))
+
+	# Previous files are moved aside first, as shards may have moved and tasks may be rendered before all are reused.
+	# The previous index is removed until the new one is written, so an interrupted run reuses nothing next time.
+	previous = {}
+	if options.incremental and index_output is not None:
+		previous = {shard['hash']: shard for shard in read_index(index_output) if shard.get('hash') is not None}
+		if previous:
+			os.remove(index_output + '.index.json')
+		for old in previous.values():
+			for key, output in outputs:
+				for extension in extensions:
+					path = os.path.join(os.path.dirname(output), old[key]) + extension
+					if os.path.exists(path):
+						os.replace(path, path + '.moving')
+
+	previous_shards = list(previous.values())
+	previous_store = None
+	if previous and store is not None and os.path.exists(store.path):
+		from extraction_store import ExtractionStore
+		try:
+			previous_store = ExtractionStore(store.path)
+		except ValueError:
+			pass
+	shards = []
+	for index, nodes in enumerate(shard_nodes(declarations, options.shard), 1):
+		name = shard_name(nodes, index)
+		shard = {'name': name, 'kind': type(nodes[0]).__name__, 'line': nodes[0].coord.line,
+		         'declarations': len(nodes), 'hash': None, 'ast': None, 'expressions': None, 'data_flow': None}
+		for key, output in outputs:
+			shard[key] = os.path.basename(f'{output}.{name}')
+		shards.append(shard)
+
+		if options.incremental:
+			from ast_cache import ast_digest
+
+			shard['hash'] = ast_digest(nodes, *settings)
+			old = previous.pop(shard['hash'], None)
+			moves = []
+			if old is not None:
+				moves = [(os.path.join(os.path.dirname(output), old[key]) + extension + '.moving',
+				          f'{output}.{name}{extension}') for key, output in outputs for extension in extensions]
+			reusable = old is not None and all(os.path.exists(old_path) for old_path, _ in moves)
+			if reusable and store is not None:
+				reusable = previous_store is not None and old['name'] in previous_store.names
+			if reusable:
+				if verbosity > 0:
+					print(f"Reusing unchanged graphs for '{name}'...")
+				for old_path, new_path in moves:
+					os.replace(old_path, new_path)
+				if store is not None:
+					store.copy(previous_store, old['name'], name)
+
+				# The index is rebuilt for the whole file, so still needs the shard's expressions
+				if hasher is not None and hasher.index is not None:
+					extractor.extract_nodes(nodes)
+					hasher.nodes = []
+					if data_flow is not None:
+						data_flow.take()
+					if folder is not None:
+						folder.dropped, folder.folded = set(), {}
+				shard['ast_nodes'] = old['ast_nodes']
+				shard['expression_nodes'] = old['expression_nodes']
+				continue
+
+		with instrumentation.stage('walk'):
+			extraction = extractor.extract_nodes(nodes)
+		count_extraction(instrumentation, extractor, extraction)
+		instrumentation.count('shards')
+		extraction = collapse_extraction(instrumentation, extraction, folder, hasher)
+		shard['ast_nodes'] = len(extraction.ast_graph)
+		shard['expression_nodes'] = len(extraction.expressions)
+		if store is not None:
+			with instrumentation.stage('store'):
+				store.add(name, extraction)
+		if ast_output is not None:
+			yield extraction.ast_graph, f'{ast_output}.{name}', f"AST graph for '{name}'", options
+		if expressions_output is not None:
+			yield extraction.expressions, f'{expressions_output}.{name}', f"expression graphs for '{name}'", options
+		if data_flow is not None:
+			yield (count_data_flow(instrumentation, data_flow.take()), f'{data_flow_output}.{name}',
+			       f"data-flow graph for '{name}'", options)
+
+	if previous_store is not None:
+		previous_store.close()
+
+	# Remove any previous files that were not reused
+	for old in previous_shards:
+		for key, output in outputs:
+			for extension in extensions:
+				path = os.path.join(os.path.dirname(output), old[key]) + extension + '.moving'
+				if os.path.exists(path):
+					os.remove(path)
+
+	if index_output is not None:
 		if verbosity > 0:
-			print(f"Outputting expression graphs to '{expressions_output}.png'...")
-		expressions.draw(expressions_output + '.png')
+			print(f"Outputting shard index to '{index_output}.index.json'...")
+		with open(index_output + '.index.json', 'w') as f:
+			json.dump({'source': source_filename, 'shards': shards}, f, indent='\t')
+
+
+def read_index(index_output):
+	try:
+		with open(index_output + '.index.json') as f:
+			return json.load(f)['shards']
+	except (OSError, ValueError, KeyError):
+		return []
+
+
+def render_task(task, instrumentation=None):
+	# Render a graph, returning the instrumentation so that timings can be collected from worker processes
+	if instrumentation is None:
+		reset_peak_memory()
+		instrumentation = Instrumentation()
+	graph, output, description, options = task
+
+	# The HTML viewer is written straight from the graph, needing neither graphviz nor a layout
+	if options.html:
+		from html_viewer import write_viewer
+		if options.verbose > 0:
+			print(f"Outputting {description} to '{output}.html'...")
+		with instrumentation.stage('html'):
+			write_viewer(graph, output + '.html', f'{os.path.basename(output)}: {description}')
+		if not (options.dot or options.png):
+			return instrumentation
+
+	with instrumentation.stage('graph'):
+		agraph = graph.to_agraph()
+	render(agraph, output, description, options.dot, options.png, options.verbose, layout_engine(len(graph), options),
+	       instrumentation)
+	return instrumentation
+
+
+def render_file(dot_filename, options, instrumentation):
+	# Lay out and draw a previously written (unlaid-out) DOT file to a PNG file alongside it
+	import pygraphviz as pgv
+
+	if options.verbose > 0:
+		print(f"Reading graph '{dot_filename}'...")
+	with instrumentation.stage('read'):
+		graph = pgv.AGraph(dot_filename)
+	engine = layout_engine(graph.number_of_nodes(), options)
+	if engine == 'none':
+		raise ValueError(f"graph has {graph.number_of_nodes()} nodes, more than the {options.max_layout_nodes} "
+		                 "allowed for layout")
+	render(graph, os.path.splitext(dot_filename)[0], 'graph', png=True, verbosity=options.verbose, engine=engine,
+	       instrumentation=instrumentation)
+
+
+def run_job(job, instrumentation, render=None, preprocessed=None):
+	if job.options.render:
+		render_file(job.source_filename, job.options, instrumentation)
+	else:
+		process_file(job.source_filename, job.cpp_args, job.ast_output, job.expressions_output, job.options,
+		             job.records_output, instrumentation, render, job.data_flow_output, preprocessed, job.store_output)
+
+
+def process_job(job, sequence=None):
+	# Run a single batch job, returning any failure as a message rather than raising across the process pool. In a
+	# pipeline's extraction workers, graphs are queued for its render workers rather than rendered here, tagged with
+	# the job's sequence number (as one source may be in several jobs). A source preprocessed in a separate stage counts
+	# that stage's timings as the job's own, and is not sent back. Peak memory is measured from the start of the job, as
+	# workers are reused for many jobs.
+	reset_peak_memory()
+	instrumentation = Instrumentation()
+	preprocessed = None
+	if job.preprocessed is not None:
+		preprocessed, preprocessing = job.preprocessed
+		instrumentation.merge(preprocessing)
+		job = job._replace(preprocessed=None)
+		if isinstance(preprocessed, Exception):
+			return job, '{}: {}'.format(type(preprocessed).__name__, preprocessed), instrumentation
+	render = None
+	if render_queue is not None:
+		render = lambda task: render_queue.put((sequence, task))
+	try:
+		run_job(job, instrumentation, render, preprocessed)
+	except Exception as error:
+		return job, '{}: {}'.format(type(error).__name__, error), instrumentation
+	return job, None, instrumentation
+
+
+def preprocess_job(job):
+	# Preprocess a job's source ahead of running it, keeping any error to report as the job's failure
+	options = job.options
+	instrumentation = Instrumentation()
+	cpp_cache = PreprocessCache(options.cache) if options.cache is not None else None
+	try:
+		text = preprocess_source(job.source_filename, options.cpp, job.cpp_args or '', instrumentation, options.fast,
+		                         cpp_cache)
+	except Exception as error:
+		text = error
+
+	# Peak memory is the job's own, not that of the process preprocessing it
+	instrumentation.peak_memory = None
+	return job._replace(preprocessed=(text, instrumentation))
+
+
+def preprocess_jobs(jobs, workers):
+	# Preprocess the sources of upcoming jobs in a pool of worker processes, so that cpp runs for several files at once
+	# and alongside parsing. Jobs are yielded in order with their preprocessed source, with at most twice as many files
+	# as workers preprocessed ahead of those yielded. (Threads would do to wait on cpp, but other pools' workers are
+	# forked while this runs, and must not inherit locks held by its threads.)
+	import concurrent.futures
+
+	with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+		pending = collections.deque()
+		for job in jobs:
+			pending.append(executor.submit(preprocess_job, job))
+			if len(pending) >= workers * 2:
+				yield pending.popleft().result()
+		while pending:
+			yield pending.popleft().result()
+
+
+def bounded_jobs(executor, jobs, limit):
+	# Run jobs in a process pool, yielding their results as they complete. Jobs are only submitted as earlier ones
+	# complete, with at most limit pending, so a lazily produced list of jobs is never consumed all at once.
+	import concurrent.futures
+
+	jobs = iter(jobs)
+	pending = set()
+	while True:
+		for job in jobs:
+			pending.add(executor.submit(process_job, job))
+			if len(pending) >= limit:
+				break
+		if not pending:
+			return
+		done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+		for future in done:
+			yield future.result()
+
+
+def init_extraction_worker(queue):
+	global render_queue
+	render_queue = queue
+
+
+def pipeline_jobs(jobs, workers):
+	# Run jobs in two stages connected by a bounded queue: extraction workers parse files and extract their graphs,
+	# which render workers lay out and draw, so that neither stage leaves the CPUs idle while the other is busy.
+	# Extraction waits when the queue is full, so graphs never pile up faster than they are rendered. Yields the
+	# result of each job once all of its graphs have been rendered.
+	import concurrent.futures
+	import multiprocessing
+	import queue
+	import threading
+
+	context = multiprocessing.get_context()
+	graphs = context.Queue(workers * 2)
+	events = queue.Queue()
+	slots = threading.Semaphore(workers * 2)
+	extract_executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=context,
+	                                                          initializer=init_extraction_worker, initargs=(graphs,))
+	render_executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=context)
+
+	def submit_renders():
+		# Move graphs from the queue to the render workers, only taking more as rendering keeps up
+		while True:
+			item = graphs.get()
+			if item is None:
+				return
+			sequence, task = item
+			slots.acquire()
+			future = render_executor.submit(render_task, task)
+			future.add_done_callback(lambda future, sequence=sequence:
+			                         (slots.release(), events.put(('rendered', sequence, future))))
+
+	submitter = threading.Thread(target=submit_renders, daemon=True)
+	submitter.start()
+
+	# Jobs are submitted for extraction as earlier ones are extracted, so a lazily produced list of jobs (e.g. as their
+	# sources are preprocessed) is never consumed all at once
+	jobs = enumerate(jobs)
+
+	def submit_extraction():
+		sequence, job = next(jobs, (None, None))
+		if job is None:
+			return 0
+		extract_executor.submit(process_job, job, sequence).add_done_callback(
+			lambda future: events.put(('extracted', sequence, future)))
+		return 1
+
+	submitted = sum(submit_extraction() for _ in range(workers * 2))
+
+	# A job is finished once it has been extracted and as many of its graphs have been rendered as it queued. Jobs are
+	# tracked by their sequence number, and forgotten once finished.
+	extracted = {}
+	rendered = collections.Counter()
+	renders = collections.defaultdict(Instrumentation)
+	errors = {}
+	finished = 0
+	try:
+		while finished < submitted:
+			kind, sequence, future = events.get()
+			if kind == 'extracted':
+				submitted += submit_extraction()
+				extracted[sequence] = future.result()
+			else:
+				rendered[sequence] += 1
+				error = future.exception()
+				if error is None:
+					renders[sequence].merge(future.result())
+				else:
+					errors.setdefault(sequence, '{}: {}'.format(type(error).__name__, error))
+
+			if sequence in extracted and rendered[sequence] == extracted[sequence][2].counters['graphs']:
+				job, error, instrumentation = extracted.pop(sequence)
+				instrumentation.merge(renders.pop(sequence, Instrumentation()))
+				rendered.pop(sequence, None)
+				finished += 1
+				yield job, error or errors.pop(sequence, None), instrumentation
+	finally:
+		extract_executor.shutdown(wait=False, cancel_futures=True)
+		graphs.put(None)
+		submitter.join()
+		render_executor.shutdown(cancel_futures=True)
+		extract_executor.shutdown()
+
+
+def write_stats(options, source_filename, instrumentation, error=None):
+	# Append a JSON record of a file's stage timings, counters and peak memory to the statistics output
+	if options.stats is None:
+		return
+	record = dict(source=source_filename, error=error, **instrumentation.report())
+	if options.stats == '-':
+		print(json.dumps(record), file=sys.stderr)
+	else:
+		with open(options.stats, 'a') as f:
+			f.write(json.dumps(record) + '\n')
+
+
+def compile_commands_sources(path):
+	# Read source files and their preprocessor flags (-I, -D, -U, -include) from a compile_commands.json
+	with open(path) as f:
+		commands = json.load(f)
+
+	sources = []
+	for entry in commands:
+		directory = entry.get('directory', os.path.dirname(os.path.abspath(path)))
+		if 'arguments' in entry:
+			arguments = entry['arguments']
+		else:
+			arguments = shlex.split(entry['command'])
+
+		flags = []
+		arguments = iter(arguments[1:])
+		for argument in arguments:
+			if argument in ('-I', '-D', '-U', '-include', '-isystem'):
+				value = next(arguments, '')
+				if argument in ('-I', '-isystem', '-include'):
+					value = os.path.join(directory, value)
+				flags += [argument, value]
+			elif argument.startswith('-I') or argument.startswith('-isystem'):
+				prefix = '-I' if argument.startswith('-I') else '-isystem'
+				flags.append(prefix + os.path.join(directory, argument[len(prefix):]))
+			elif argument.startswith('-D') or argument.startswith('-U'):
+				flags.append(argument)
+
+		sources.append((os.path.join(directory, entry['file']), flags))
+	return sources
+
+
+def find_sources(paths, extension='.c'):
+	# Expand directories and glob patterns into a sorted, de-duplicated list of source files
+	sources = []
+	for path in paths:
+		if os.path.isdir(path):
+			sources += sorted(glob.glob(os.path.join(path, '**', '*' + extension), recursive=True))
+		elif glob.has_magic(path):
+			sources += sorted(glob.glob(path, recursive=True))
+		else:
+			sources.append(path)
+	return list(dict.fromkeys(sources))
+
+
+def output_path(output, source_filename, root, extension='', variant=1):
+	# In batch mode, outputs are placed in a directory tree mirroring the sources. A source processed more than once
+	# (with different preprocessor flags) has its later outputs numbered, e.g. 'file.2'.
+	if output is None or root is None:
+		return output
+	name = os.path.splitext(os.path.relpath(source_filename, root))[0]
+	if variant > 1:
+		name += f'.{variant}'
+	path = os.path.join(output, name)
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	return path + extension
+
+
+def evict_cache(options):
+	if options.cache is not None:
+		from ast_cache import ASTCache
+		ASTCache(options.cache, options.cache_size * 1024 * 1024).evict()
+
+
+def job_count(options):
+	return options.jobs if options.jobs > 0 else os.cpu_count()
+
+
+def shard_type(value):
+	if value == 'function':
+		return value
+	if not value.isdigit() or int(value) < 1:
+		raise argparse.ArgumentTypeError("must be 'function' or a positive number of declarations")
+	return int(value)
+
+
+def query_type(value):
+	from expression_query import Query
+	try:
+		return Query(value)
+	except ValueError as e:
+		raise argparse.ArgumentTypeError(str(e))
+
+
+def argument_parser():
+	parser = argparse.ArgumentParser(description='Extract expressions from C source.')
+	parser.add_argument('source_files', nargs='*', metavar='source_file',
+	                    help='C source files, directories or glob patterns to process')
+	parser.add_argument('-c', '--cpp', metavar='cpp_path', type=str, default='cpp',
+	                    help="path to C preprocessor executable (default 'cpp')")
+	parser.add_argument('-a', '--cppargs', metavar='cpp_args', type=str, default='',
+	                    help="additional C preprocessor arguments (default none)")
+	parser.add_argument('--fast', action='store_true',
+	                    help='skip running the C preprocessor on files without directives or predefined macros, just '
+	                         'removing comments as it would')
+	parser.add_argument('-t', '--ast', metavar='output_file',
+	                    help='output AST graph to this file (a directory when processing multiple files)')
+	parser.add_argument('-e', '--expressions', metavar='output_file',
+	                    help='output expression graphs to this file (a directory when processing multiple files)')
+	parser.add_argument('-u', '--data-flow', metavar='output_file',
+	                    help='output a data-flow graph, linking variable definitions to the uses they reach, to this file '
+	                         '(a directory when processing multiple files)')
+	parser.add_argument('-b', '--store', metavar='output_file',
+	                    help='output the extracted graphs to this binary store, read with extraction_store.py (a '
+	                         'directory when processing multiple files)')
+	parser.add_argument('-p', '--png', action='store_true', help='output PNG file')
+	parser.add_argument('-d', '--dot', action='store_true', help='output DOT file')
+	parser.add_argument('--html', action='store_true',
+	                    help='output a self-contained HTML viewer, drawing each function or expression as it is opened '
+	                         '(needs no layout)')
+	parser.add_argument('-l', '--layout', metavar='engine', default='dot',
+	                    help="graphviz layout engine, or 'none' to write DOT files without layout (default 'dot')")
+	parser.add_argument('--max-layout-nodes', metavar='N', type=int, default=0,
+	                    help='use the large graph layout engine for graphs with more than N nodes (default no limit)')
+	parser.add_argument('--large-layout', metavar='engine', default='sfdp',
+	                    help="layout engine for large graphs, or 'none' to refuse layout (default 'sfdp')")
+	parser.add_argument('-r', '--render', action='store_true',
+	                    help='render previously written DOT files (or directories of them) to PNG files')
+	parser.add_argument('-x', '--extended', action='store_true',
+	                    help='label and colour function calls, array and structure references, casts and ternary '
+	                         'operators in expressions')
+	parser.add_argument('--index', metavar='index_file',
+	                    help='add structural hashes of every (sub)expression to this index of where they occur, '
+	                         'queried with expression_index.py')
+	parser.add_argument('--share-duplicates', action='store_true',
+	                    help='draw repeated subexpressions once in expression graphs, linking to their first occurrence')
+	parser.add_argument('--fold', action='store_true',
+	                    help='evaluate constant integer subexpressions as C would (on x86-64), drawing each as a single '
+	                         'node in expression graphs and adding their values to JSON records')
+	parser.add_argument('--control-flow', action='store_true',
+	                    help='group expressions into the basic blocks they run in, joined by the branches and loops of '
+	                         'if, switch, for, while and do statements, rather than ordering them in one line')
+	parser.add_argument('--select', metavar='query', type=query_type, action='append',
+	                    help="only extract expressions matching this query, e.g. 'kind:Assignment target:d[]' or "
+	                         "'kind:Return function:main line:10-20' (see expression_query.py, may be repeated to "
+	                         "select expressions matching any), leaving the rest of the AST out of its graph")
+	parser.add_argument('-s', '--shard', metavar='function|N', type=shard_type,
+	                    help='output separate graphs for each function, or for every N top-level declarations, along '
+	                         'with an index of them')
+	parser.add_argument('-i', '--incremental', action='store_true',
+	                    help='reuse the graphs of shards unchanged since the last run (implies --shard function)')
+	parser.add_argument('-m', '--low-memory', action='store_true',
+	                    help='parse, extract and output one shard at a time, so memory use depends on the largest '
+	                         'function rather than the whole file (implies --shard function, does not use --cache)')
+	parser.add_argument('-f', '--format', choices=('graph', 'jsonl'), default='graph',
+	                    help="output graphs, or stream one JSON record per expression without building graphs "
+	                         "(default 'graph')")
+	parser.add_argument('-o', '--output', metavar='output_file',
+	                    help='write JSON records to this file rather than stdout (a directory when processing multiple '
+	                         'files)')
+	parser.add_argument('-C', '--compile-commands', metavar='json_file',
+	                    help='also process every file listed in this compile_commands.json')
+	parser.add_argument('-j', '--jobs', metavar='N', type=int, default=1,
+	                    help='number of worker processes (default 1, 0 for one per CPU)')
+	parser.add_argument('--cpp-jobs', metavar='N', type=int, default=0,
+	                    help='number of C preprocessor processes run at once ahead of parsing when processing multiple '
+	                         'files (default 0, as many as --jobs)')
+	parser.add_argument('--cache', metavar='directory',
+	                    help='cache preprocessed source and parsed ASTs in this directory, skipping preprocessing of '
+	                         'files whose headers are unchanged and parsing of unchanged preprocessed source')
+	parser.add_argument('--cache-size', metavar='MB', type=int, default=512,
+	                    help='maximum size of the AST cache, least recently used entries are evicted (default 512)')
+	parser.add_argument('--stats', metavar='output_file',
+	                    help="append per-file stage timings, counters and peak memory as JSON lines to this file "
+	                         "('-' for stderr)")
+	parser.add_argument('-v', '--verbose', action='count', default=0, help='verbose output')
+	return parser
+
+
+def check_arguments(parser, args):
+	# Fill in options implied by others, and reject combinations that cannot work
+	if (args.incremental or args.low_memory) and args.shard is None:
+		args.shard = 'function'
+	if args.store is not None and args.format == 'jsonl':
+		parser.error('a store holds extracted graphs, which are not built with --format jsonl')
+	if args.data_flow is not None and args.format == 'jsonl':
+		parser.error('data-flow graphs are built alongside expression graphs, which are not built with --format jsonl')
+	if args.control_flow and args.select:
+		parser.error('--control-flow joins the blocks of every expression, so cannot be used with --select')
+	if args.png and args.layout == 'none':
+		parser.error("PNG output needs a layout engine, use --render to draw DOT files written with '--layout none'")
+
+
+def main(argv=None):
+	parser = argument_parser()
+	args = parser.parse_args(argv)
+	check_arguments(parser, args)
+
+	base_cpp_args = [args.cppargs] if args.cppargs != '' else []
+	sources = [(source, base_cpp_args) for source in find_sources(args.source_files, '.dot' if args.render else '.c')]
+	if args.compile_commands is not None:
+		sources += [(source, base_cpp_args + flags) for source, flags in compile_commands_sources(args.compile_commands)]
+	if not sources:
+		parser.error('no source files given')
+
+	# A source listed again with the same flags is only processed once
+	sources = [(source, list(cpp_args)) for source, cpp_args in
+	           dict.fromkeys((source, tuple(cpp_args)) for source, cpp_args in sources)]
+
+	# A single file keeps the original output naming and error behaviour
+	if len(sources) == 1:
+		source_filename, cpp_args = sources[0]
+		instrumentation = Instrumentation()
+		run_job(Job(source_filename, cpp_args or '', args.ast, args.expressions, args.output or '-', args,
+		            args.data_flow, args.store), instrumentation)
+		write_stats(args, source_filename, instrumentation)
+		evict_cache(args)
+		if args.verbose > 0:
+			print('Done.', file=sys.stderr if args.format == 'jsonl' else sys.stdout)
+		return 0
+
+	import shutil
+	import tempfile
+
+	# Files are processed in parallel, so the graphs for each file are rendered one after another
+	worker_options = argparse.Namespace(**vars(args))
+	worker_options.jobs = 1
+
+	root = os.path.commonpath([os.path.dirname(os.path.abspath(source)) for source, _ in sources])
+	occurrences = collections.Counter()
+	variants = []
+	for source, _ in sources:
+		occurrences[os.path.abspath(source)] += 1
+		variants.append(occurrences[os.path.abspath(source)])
+	jobs = [Job(source, cpp_args, output_path(args.ast, os.path.abspath(source), root, variant=variant),
+	            output_path(args.expressions, os.path.abspath(source), root, variant=variant), None, worker_options,
+	            output_path(args.data_flow, os.path.abspath(source), root, variant=variant),
+	            output_path(args.store, os.path.abspath(source), root, '.store', variant))
+	        for (source, cpp_args), variant in zip(sources, variants)]
+
+	# Records for each file are written separately, then copied to stdout in turn so they are never interleaved
+	records_directory = None
+	if args.format == 'jsonl':
+		if args.output is not None:
+			jobs = [job._replace(records_output=output_path(args.output, os.path.abspath(job.source_filename), root,
+			                                                '.jsonl', variant)) for job, variant in zip(jobs, variants)]
+		else:
+			records_directory = tempfile.mkdtemp(prefix='expressions-')
+			jobs = [job._replace(records_output=os.path.join(records_directory, f'{index}.jsonl'))
+			        for index, job in enumerate(jobs)]
+
+	# Sources are preprocessed in a stage of their own, running several cpp processes at once ahead of parsing
+	workers = job_count(args)
+	pending_jobs = jobs
+	if not args.render:
+		pending_jobs = preprocess_jobs(jobs, args.cpp_jobs if args.cpp_jobs > 0 else workers)
+
+	# Graphs are rendered by their own pool of workers, fed by those extracting them
+	executor = None
+	pipeline = None
+	if workers > 1 and args.format == 'graph' and not args.render:
+		results = pipeline = pipeline_jobs(pending_jobs, workers)
+	elif workers > 1:
+		import concurrent.futures
+
+		executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+		results = bounded_jobs(executor, pending_jobs, workers * 2)
+	else:
+		results = map(process_job, pending_jobs)
+
+	# Report progress and failures as each file completes
+	failures = []
+	try:
+		for done, (job, error, instrumentation) in enumerate(results, 1):
+			write_stats(args, job.source_filename, instrumentation, error)
+			if records_directory is not None and os.path.exists(job.records_output):
+				with open(job.records_output) as f:
+					shutil.copyfileobj(f, sys.stdout)
+				os.remove(job.records_output)
+			if error is None:
+				print(f"[{done}/{len(jobs)}] {job.source_filename}", file=sys.stderr)
+			else:
+				failures.append((job.source_filename, error))
+				print(f"[{done}/{len(jobs)}] {job.source_filename}: FAILED: {error}", file=sys.stderr)
+	finally:
+		if executor is not None:
+			executor.shutdown(cancel_futures=True)
+		if pipeline is not None:
+			pipeline.close()
+		if records_directory is not None:
+			shutil.rmtree(records_directory, ignore_errors=True)
+	evict_cache(args)
+
+	print(f"Processed {len(jobs)} files, {len(failures)} failed", file=sys.stderr)
+	for source_filename, error in failures:
+		print(f"  {source_filename}: {error}", file=sys.stderr)
+	return 1 if failures else 0
+
 
-if verbosity > 0:
-	print('Done.')
+if __name__ == '__main__':
+	sys.exit(main())
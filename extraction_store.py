@@ -0,0 +1,437 @@
+#!/usr/bin/env python3
+
+# Compact binary store of extracted graphs, so they can be reused without parsing DOT text. A store holds a part for
+# each file or shard, each with the column tables of its AST and expression graphs (as held by GraphIR), an interned
+# string table, and a directory of its expressions. Parts are read in place through mmap, so only the parts, functions
+# or expressions asked for are ever loaded.
+
+import argparse
+import bisect
+import collections
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+from graph_ir import GraphIR
+
+MAGIC = b'EXST'
+
+# Bump when the layout below changes
+FORMAT_VERSION = 1
+
+# The file starts with its magic number and version, and the offset and length of the part directory (JSON, written at
+# the end of the file once every part is written)
+HEADER = struct.Struct('<4sIQQ')
+
+GRAPH_COLUMNS = ['attributes', 'roots', 'root_groups', 'subgraph_parents', 'subgraph_names', 'subgraph_attributes',
+                 'node_ids', 'node_labels', 'node_colors', 'node_shapes', 'node_styles', 'node_subgraphs',
+                 'edge_tails', 'edge_heads', 'edge_labels', 'edge_directions', 'edge_subgraphs', 'edge_positions']
+
+# Every column of a part is a table of 32-bit integers (strings being indices into its string table), apart from the
+# UTF-8 text of the strings themselves. Expressions list the rows of the nodes and edges drawn for them, with the start
+# of each expression's rows in the offsets columns.
+PART_COLUMNS = (['strings', 'text'] + [f'ast_{column}' for column in GRAPH_COLUMNS] +
+                [f'expression_{column}' for column in GRAPH_COLUMNS] +
+                ['directory_subgraphs', 'directory_files', 'directory_lines', 'directory_columns',
+                 'directory_node_offsets', 'directory_node_rows', 'directory_edge_offsets', 'directory_edge_rows'])
+
+# Each part starts with the offset (from the start of the part) and length of each of its columns
+PART_HEADER = struct.Struct('<' + 'QQ' * len(PART_COLUMNS))
+
+INTEGER = struct.Struct('<i')
+
+# Columns are stored little-endian
+NATIVE = sys.byteorder == 'little'
+
+StoredExpression = collections.namedtuple('StoredExpression', ['part', 'index', 'id', 'function', 'file', 'line',
+                                                               'column'])
+
+
+def integers(values):
+	column = array('i', values)
+	if not NATIVE:
+		column.byteswap()
+	return column.tobytes()
+
+
+class StringTable:
+	# Interns strings as they are added to a part, numbering each distinct string once (None being -1)
+	def __init__(self):
+		self.ids = {}
+		self.strings = []
+
+	def __call__(self, string):
+		if string is None:
+			return -1
+		string_id = self.ids.get(string)
+		if string_id is None:
+			string_id = self.ids[string] = len(self.strings)
+			self.strings.append(string)
+		return string_id
+
+	def columns(self):
+		# The end offset of each string in the text, and the text itself
+		ends = []
+		text = bytearray()
+		for string in self.strings:
+			text += string.encode()
+			ends.append(len(text))
+		return integers(ends), bytes(text)
+
+
+def graph_columns(graph, intern):
+	return {
+		'attributes': integers([int(graph.ordered), intern(json.dumps(graph.attributes))]),
+		'roots': integers(graph.roots),
+		'root_groups': integers(map(intern, graph.root_groups)),
+		'subgraph_parents': integers(graph.subgraph_parents),
+		'subgraph_names': integers(map(intern, graph.subgraph_names)),
+		'subgraph_attributes': integers(intern(json.dumps(attributes)) for attributes in graph.subgraph_attributes),
+		'node_ids': integers(graph.node_ids),
+		'node_labels': integers(map(intern, graph.node_labels)),
+		'node_colors': integers(map(intern, graph.node_colors)),
+		'node_shapes': integers(map(intern, graph.node_shapes)),
+		'node_styles': integers(map(intern, graph.node_styles)),
+		'node_subgraphs': integers(graph.node_subgraphs),
+		'edge_tails': integers(graph.edge_tails),
+		'edge_heads': integers(graph.edge_heads),
+		'edge_labels': integers(map(intern, graph.edge_labels)),
+		'edge_directions': integers(map(intern, graph.edge_directions)),
+		'edge_subgraphs': integers(graph.edge_subgraphs),
+		'edge_positions': integers(graph.edge_positions),
+	}
+
+
+def expression_directory(graph, intern):
+	# Find the cluster and coordinate of each expression, and the rows drawn for it: the nodes in its cluster, and the
+	# edges in its cluster or joining its nodes to others outside any cluster (e.g. to a shared subexpression)
+	rows = {node_id: row for row, node_id in enumerate(graph.node_ids)}
+	subgraphs = [graph.node_subgraphs[rows[root]] if root in rows else -1 for root in graph.roots]
+	expressions = {subgraph: index for index, subgraph in enumerate(subgraphs)}
+
+	def expression_of(subgraph):
+		while subgraph > 0 and subgraph not in expressions:
+			subgraph = graph.subgraph_parents[subgraph]
+		return expressions.get(subgraph)
+
+	node_rows = [[] for _ in subgraphs]
+	owners = {}
+	for row, (node_id, subgraph) in enumerate(zip(graph.node_ids, graph.node_subgraphs)):
+		index = expression_of(subgraph)
+		if index is not None:
+			node_rows[index].append(row)
+			owners[node_id] = index
+
+	edge_rows = [[] for _ in subgraphs]
+	for row, (tail_id, head_id, subgraph) in enumerate(zip(graph.edge_tails, graph.edge_heads, graph.edge_subgraphs)):
+		index = expression_of(subgraph)
+		if index is not None:
+			edge_rows[index].append(row)
+		else:
+			for index in {owners.get(tail_id), owners.get(head_id)} - {None}:
+				edge_rows[index].append(row)
+
+	# Expression clusters are labelled with their coordinate, e.g. 'file.c:12:5'
+	files, lines, columns = [], [], []
+	for subgraph in subgraphs:
+		label = graph.subgraph_attributes[subgraph].get('label', '') if subgraph >= 0 else ''
+		file, _, position = label.rpartition(':')
+		file, _, line = file.rpartition(':')
+		valid = line.isdigit() and position.isdigit()
+		files.append(intern(file if valid else None))
+		lines.append(int(line) if valid else -1)
+		columns.append(int(position) if valid else -1)
+
+	def offsets(groups):
+		ends = [0]
+		for group in groups:
+			ends.append(ends[-1] + len(group))
+		return ends
+
+	return {
+		'directory_subgraphs': integers(subgraphs),
+		'directory_files': integers(files),
+		'directory_lines': integers(lines),
+		'directory_columns': integers(columns),
+		'directory_node_offsets': integers(offsets(node_rows)),
+		'directory_node_rows': integers(row for group in node_rows for row in group),
+		'directory_edge_offsets': integers(offsets(edge_rows)),
+		'directory_edge_rows': integers(row for group in edge_rows for row in group),
+	}
+
+
+def encode_part(extraction):
+	# Encode an extraction's graphs as a part, with its columns aligned to 8 bytes after its header
+	intern = StringTable()
+	columns = {f'ast_{name}': column for name, column in graph_columns(extraction.ast_graph, intern).items()}
+	columns.update({f'expression_{name}': column
+	                for name, column in graph_columns(extraction.expressions, intern).items()})
+	columns.update(expression_directory(extraction.expressions, intern))
+	columns['strings'], columns['text'] = intern.columns()
+
+	positions = []
+	data = bytearray(PART_HEADER.size)
+	for name in PART_COLUMNS:
+		data += bytes(-len(data) % 8)
+		positions += [len(data), len(columns[name])]
+		data += columns[name]
+	PART_HEADER.pack_into(data, 0, *positions)
+	return data
+
+
+class StoreWriter:
+	# Parts are written to a temporary file as they are added, which is renamed into place once complete, so readers
+	# never see a partial store
+	def __init__(self, path):
+		self.path = path
+		self.temporary = f"{path}.{os.getpid()}.tmp"
+		self.file = open(self.temporary, 'wb')
+		self.file.write(HEADER.pack(MAGIC, FORMAT_VERSION, 0, 0))
+		self.parts = []
+
+	def write_part(self, entry, data):
+		self.file.write(bytes(-self.file.tell() % 8))
+		self.parts.append(dict(entry, offset=self.file.tell(), length=len(data)))
+		self.file.write(data)
+
+	def add(self, name, extraction):
+		# The functions in a part are listed in the directory, so they can be found without reading the part
+		groups = extraction.expressions.root_groups
+		entry = {'name': name, 'expressions': len(groups),
+		         'functions': list(dict.fromkeys(group for group in groups if group is not None))}
+		self.write_part(entry, encode_part(extraction))
+
+	def copy(self, store, name, new_name=None):
+		# Copy a part unchanged from another store (e.g. an unchanged shard from the previous run), possibly renamed
+		entry = store.entry(name)
+		self.write_part(dict(entry, name=name if new_name is None else new_name),
+		                store.buffer[entry['offset']:entry['offset'] + entry['length']])
+
+	def close(self):
+		directory = json.dumps(self.parts).encode()
+		offset = self.file.tell()
+		self.file.write(directory)
+		self.file.seek(0)
+		self.file.write(HEADER.pack(MAGIC, FORMAT_VERSION, offset, len(directory)))
+		self.file.close()
+		os.replace(self.temporary, self.path)
+
+	def discard(self):
+		self.file.close()
+		os.remove(self.temporary)
+
+
+class StoredPart:
+	# One part of a store, reading its columns from the mapped file as they are needed
+	def __init__(self, buffer, entry):
+		self.buffer = buffer
+		self.name = entry['name']
+		self.start = entry['offset']
+		positions = PART_HEADER.unpack_from(buffer, self.start)
+		self.columns = {name: (self.start + positions[2 * index], positions[2 * index + 1])
+		                for index, name in enumerate(PART_COLUMNS)}
+		self.strings = {}
+
+	def __len__(self):
+		return self.columns['directory_subgraphs'][1] // 4
+
+	def values(self, name, start=0, stop=None):
+		# Rows start to stop of a column, as an array
+		offset, length = self.columns[name]
+		stop = length // 4 if stop is None else stop
+		column = array('i', self.buffer[offset + 4 * start:offset + 4 * stop])
+		if not NATIVE:
+			column.byteswap()
+		return column
+
+	def value(self, name, row):
+		return INTEGER.unpack_from(self.buffer, self.columns[name][0] + 4 * row)[0]
+
+	def string(self, string_id):
+		if string_id < 0:
+			return None
+		string = self.strings.get(string_id)
+		if string is None:
+			start = self.value('strings', string_id - 1) if string_id > 0 else 0
+			offset = self.columns['text'][0]
+			end = self.value('strings', string_id)
+			string = self.strings[string_id] = self.buffer[offset + start:offset + end].decode()
+		return string
+
+	def expressions(self):
+		columns = zip(self.values('expression_roots'), self.values('expression_root_groups'),
+		              self.values('directory_files'), self.values('directory_lines'), self.values('directory_columns'))
+		for index, (node_id, group, file, line, column) in enumerate(columns):
+			yield StoredExpression(self.name, index, node_id, self.string(group), self.string(file), line, column)
+
+	def graph_header(self, prefix):
+		ordered, attributes = self.values(prefix + 'attributes')
+		return GraphIR(bool(ordered), **json.loads(self.string(attributes)))
+
+	def load_graph(self, prefix):
+		# Load a whole graph, its columns read in turn
+		graph = self.graph_header(prefix)
+		graph.roots = array('l', self.values(prefix + 'roots'))
+		graph.root_groups = [self.string(group) for group in self.values(prefix + 'root_groups')]
+		graph.subgraph_parents = array('l', self.values(prefix + 'subgraph_parents'))
+		graph.subgraph_names = [self.string(name) for name in self.values(prefix + 'subgraph_names')]
+		graph.subgraph_attributes = [json.loads(self.string(attributes))
+		                             for attributes in self.values(prefix + 'subgraph_attributes')]
+		for name in GRAPH_COLUMNS[6:]:
+			column = self.values(prefix + name)
+			if name.endswith(('_ids', '_subgraphs', '_tails', '_heads', '_positions')):
+				setattr(graph, name, array('l', column))
+			else:
+				setattr(graph, name, [self.string(string_id) for string_id in column])
+		return graph
+
+	def load_ast(self):
+		return self.load_graph('ast_')
+
+	def load_expressions(self, selected=None):
+		# Load the expression graph, or only the expressions (by index) selected, with their clusters and the edges
+		# between their nodes, in the order they were first added
+		if selected is None:
+			return self.load_graph('expression_')
+		selected = sorted(set(selected))
+		graph = self.graph_header('expression_')
+
+		def rows(kind, index):
+			return self.values(f'directory_{kind}_rows', self.value(f'directory_{kind}_offsets', index),
+			                   self.value(f'directory_{kind}_offsets', index + 1))
+
+		node_rows = sorted(row for index in selected for row in rows('node', index))
+		edge_rows = sorted({row for index in selected for row in rows('edge', index)})
+
+		# Clusters are renumbered, keeping those of the selected expressions and the clusters containing them
+		subgraphs = {0: 0}
+
+		def subgraph(old):
+			new = subgraphs.get(old)
+			if new is None:
+				parent = subgraph(self.value('expression_subgraph_parents', old))
+				new = subgraphs[old] = graph.add_subgraph(
+					parent, self.string(self.value('expression_subgraph_names', old)),
+					**json.loads(self.string(self.value('expression_subgraph_attributes', old))))
+			return new
+
+		for index in selected:
+			graph.add_root(self.value('expression_roots', index),
+			               self.string(self.value('expression_root_groups', index)))
+		for row in node_rows:
+			graph.add_node(subgraph(self.value('expression_node_subgraphs', row)),
+			               self.value('expression_node_ids', row),
+			               self.string(self.value('expression_node_labels', row)),
+			               self.string(self.value('expression_node_colors', row)),
+			               self.string(self.value('expression_node_shapes', row)),
+			               self.string(self.value('expression_node_styles', row)))
+
+		# Edges keep their place among the nodes kept, and those joining a selected node to one not loaded are left out
+		loaded = set(graph.node_ids)
+		for row in edge_rows:
+			tail_id, head_id = self.value('expression_edge_tails', row), self.value('expression_edge_heads', row)
+			if tail_id not in loaded or head_id not in loaded:
+				continue
+			graph.edge_tails.append(tail_id)
+			graph.edge_heads.append(head_id)
+			graph.edge_labels.append(self.string(self.value('expression_edge_labels', row)))
+			graph.edge_directions.append(self.string(self.value('expression_edge_directions', row)))
+			graph.edge_subgraphs.append(subgraph(self.value('expression_edge_subgraphs', row)))
+			graph.edge_positions.append(bisect.bisect_left(node_rows, self.value('expression_edge_positions', row)))
+		return graph
+
+
+class ExtractionStore:
+	def __init__(self, path):
+		with open(path, 'rb') as f:
+			self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		try:
+			magic, version, offset, length = HEADER.unpack_from(self.buffer)
+			if magic != MAGIC:
+				raise ValueError(f"'{path}' is not an extraction store")
+			if version != FORMAT_VERSION:
+				raise ValueError(f"unsupported extraction store format {version}")
+			self.parts = json.loads(self.buffer[offset:offset + length].decode())
+		except (struct.error, ValueError):
+			self.buffer.close()
+			raise
+		self.names = {entry['name']: index for index, entry in enumerate(self.parts)}
+
+	def entry(self, name):
+		return self.parts[self.names[name]]
+
+	def part(self, name):
+		return StoredPart(self.buffer, self.entry(name))
+
+	def select(self, parts=None, functions=None, ids=None):
+		# Yield each part with any of the given names or functions (or every part), along with the indices of its
+		# expressions in those functions or with those root node ids (or None for all of its expressions)
+		for entry in self.parts:
+			if parts is not None and entry['name'] not in parts:
+				continue
+			if functions is not None and not set(functions) & set(entry['functions']):
+				continue
+			part = StoredPart(self.buffer, entry)
+			selected = None
+			if functions is not None or ids is not None:
+				selected = [expression.index for expression in part.expressions()
+				            if (functions is None or expression.function in functions) and
+				            (ids is None or expression.id in ids)]
+			yield part, selected
+
+	def close(self):
+		self.buffer.close()
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Read a store of extracted graphs.')
+	parser.add_argument('store', help='store file, written with expressions.py --store')
+	parser.add_argument('-p', '--part', action='append', help='only read this part, a file or shard (may be repeated)')
+	parser.add_argument('-f', '--function', action='append',
+	                    help='only read expressions in this function (may be repeated)')
+	parser.add_argument('-i', '--id', type=int, action='append',
+	                    help='only read the expression with this root node id (may be repeated)')
+	commands = parser.add_subparsers(dest='command', required=True)
+	listing = commands.add_parser('list', help='list the parts and expressions stored')
+	listing.add_argument('-j', '--json', action='store_true', help='output JSON lines')
+	dot = commands.add_parser('dot', help='write stored graphs as DOT files, without layout')
+	dot.add_argument('-t', '--ast', metavar='output_file', help="write each part's AST graph to this file")
+	dot.add_argument('-e', '--expressions', metavar='output_file', help='write expression graphs to this file')
+	args = parser.parse_args()
+
+	if not os.path.exists(args.store):
+		parser.error(f"store '{args.store}' does not exist")
+	try:
+		store = ExtractionStore(args.store)
+	except ValueError as e:
+		parser.error(str(e))
+	selected_parts = list(store.select(args.part, args.function, args.id))
+
+	if args.command == 'list':
+		for part, selected in selected_parts:
+			for expression in part.expressions():
+				if selected is not None and expression.index not in selected:
+					continue
+				if args.json:
+					print(json.dumps(expression._asdict()))
+				else:
+					print(f"{part.name}\t{expression.id}\t{expression.function or ''}\t"
+					      f"{expression.file}:{expression.line}:{expression.column}")
+	else:
+		# Parts are written to separate files, named as shards are, when there are several
+		for part, selected in selected_parts:
+			suffix = f'.{part.name}' if len(store.parts) > 1 else ''
+			if args.ast is not None:
+				part.load_ast().to_agraph().write(f'{args.ast}{suffix}.dot')
+			if args.expressions is not None:
+				part.load_expressions(selected).to_agraph().write(f'{args.expressions}{suffix}.dot')
+
+	store.close()
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+# In-memory representation of AST and expression graphs, independent of graphviz. Nodes, edges and subgraphs are held
+# in parallel column tables, and pygraphviz is only needed to render the final graph.
+
+from array import array
+
+
+class GraphIR:
+	__slots__ = ('attributes', 'ordered', 'roots', 'root_groups',
+	             'subgraph_parents', 'subgraph_names', 'subgraph_attributes',
+	             'node_ids', 'node_labels', 'node_colors', 'node_shapes', 'node_styles', 'node_subgraphs',
+	             'edge_tails', 'edge_heads', 'edge_labels', 'edge_directions', 'edge_subgraphs', 'edge_positions')
+
+	def __init__(self, ordered=False, **attributes):
+		# Subgraph 0 is the graph itself. An ordered graph keeps its root nodes (e.g. expressions) in a left-right chain,
+		# and each root may belong to a group (e.g. the function an expression is in).
+		self.attributes = attributes
+		self.ordered = ordered
+		self.roots = array('l')
+		self.root_groups = []
+
+		self.subgraph_parents = array('l', [-1])
+		self.subgraph_names = [None]
+		self.subgraph_attributes = [attributes]
+
+		self.node_ids = array('l')
+		self.node_labels = []
+		self.node_colors = []
+		self.node_shapes = []
+		self.node_styles = []
+		self.node_subgraphs = array('l')
+
+		# Each edge records how many nodes had been added before it, so construction order can be replayed exactly
+		self.edge_tails = array('l')
+		self.edge_heads = array('l')
+		self.edge_labels = []
+		self.edge_directions = []
+		self.edge_subgraphs = array('l')
+		self.edge_positions = array('l')
+
+	def __len__(self):
+		return len(self.node_ids)
+
+	def add_subgraph(self, parent, name=None, **attributes):
+		self.subgraph_parents.append(parent)
+		self.subgraph_names.append(name)
+		self.subgraph_attributes.append(attributes)
+		return len(self.subgraph_names) - 1
+
+	def add_node(self, subgraph, node_id, label, color='', shape='', style='filled'):
+		self.node_ids.append(node_id)
+		self.node_labels.append(label)
+		self.node_colors.append(color)
+		self.node_shapes.append(shape)
+		self.node_styles.append(style)
+		self.node_subgraphs.append(subgraph)
+
+	def add_edge(self, subgraph, tail_id, head_id, label='', direction=''):
+		self.edge_tails.append(tail_id)
+		self.edge_heads.append(head_id)
+		self.edge_labels.append(label)
+		self.edge_directions.append(direction)
+		self.edge_subgraphs.append(subgraph)
+		self.edge_positions.append(len(self.node_ids))
+
+	def add_root(self, node_id, group=None):
+		self.roots.append(node_id)
+		self.root_groups.append(group)
+
+	def nodes(self):
+		return zip(self.node_ids, self.node_labels, self.node_colors, self.node_shapes, self.node_styles,
+		           self.node_subgraphs)
+
+	def edges(self):
+		return zip(self.edge_tails, self.edge_heads, self.edge_labels, self.edge_directions, self.edge_subgraphs)
+
+	def subgraphs(self):
+		return zip(self.subgraph_parents, self.subgraph_names, self.subgraph_attributes)
+
+	def collapse(self, dropped, redirects, relabels=None):
+		# Copy this graph without the dropped nodes, moving edges to any dropped node in redirects onto its replacement.
+		# Moved edges go in the top-level graph, so the replacement stays in its own cluster. Nodes in relabels are given
+		# a new label, colour and shape.
+		graph = GraphIR(self.ordered, **self.attributes)
+		graph.roots = array('l', self.roots)
+		graph.root_groups = list(self.root_groups)
+		graph.subgraph_parents = array('l', self.subgraph_parents)
+		graph.subgraph_names = list(self.subgraph_names)
+		graph.subgraph_attributes = list(self.subgraph_attributes)
+
+		kept = array('l', [0])
+		for node_id, label, color, shape, style, subgraph in self.nodes():
+			if node_id not in dropped:
+				if relabels is not None and node_id in relabels:
+					label, color, shape = relabels[node_id]
+				graph.add_node(subgraph, node_id, label, color, shape, style)
+			kept.append(len(graph.node_ids))
+
+		for (tail_id, head_id, label, direction, subgraph), position in zip(self.edges(), self.edge_positions):
+			if tail_id in redirects or head_id in redirects:
+				tail_id = redirects.get(tail_id, tail_id)
+				head_id = redirects.get(head_id, head_id)
+				subgraph = 0
+			if tail_id in dropped or head_id in dropped:
+				continue
+			graph.edge_tails.append(tail_id)
+			graph.edge_heads.append(head_id)
+			graph.edge_labels.append(label)
+			graph.edge_directions.append(direction)
+			graph.edge_subgraphs.append(subgraph)
+			graph.edge_positions.append(kept[position])
+
+		return graph
+
+	def to_agraph(self):
+		import pygraphviz as pgv
+
+		agraph = pgv.AGraph(**self.attributes)
+
+		# Set up vertical alignment and deterministic left-right ordering of root nodes
+		if self.ordered:
+			agraph.add_node('rank1', label='', style='invis', width=0)
+			agraph.add_node('rank2', label='', style='invis', width=0)
+			agraph.add_edge('rank1', 'rank2', style='invis')
+			ordering = agraph.subgraph(rank='same', rankdir='LR')
+			order_id = 'rank2'
+
+		subgraphs = [agraph]
+		for parent, name, attributes in list(self.subgraphs())[1:]:
+			subgraphs.append(subgraphs[parent].subgraph(name=name, **attributes))
+
+		# Edge labels (e.g. the branches between basic blocks) are drawn beside the edges of ordered graphs, as dot
+		# doubles the ranks of any graph with edge labels, and ordered graphs are large
+		label_attribute = 'xlabel' if self.ordered else 'label'
+
+		# Replay nodes and edges in the order they were added, as graphviz output depends on creation order. Roots in
+		# clusters within another (e.g. the basic blocks of control flow) are ordered within that, after its first node.
+		chains = {}
+		first_nodes = {}
+		roots = iter(self.roots)
+		root = next(roots, None)
+		edges = self.edges()
+		edge_positions = iter(self.edge_positions)
+		edge_position = next(edge_positions, None)
+		for position, (node_id, label, color, shape, style, subgraph) in enumerate(self.nodes(), 1):
+			name = str(node_id)
+			if node_id == root:
+				parent = self.subgraph_parents[subgraph]
+				if parent <= 0:
+					ordering.add_edge(order_id, name, style='invis')
+					order_id = name
+				else:
+					if parent not in chains:
+						chains[parent] = [subgraphs[parent].subgraph(rank='same'), first_nodes.get(parent)]
+					chain = chains[parent]
+					if chain[1] is not None:
+						chain[0].add_edge(chain[1], name, style='invis')
+					chain[1] = name
+				root = next(roots, None)
+			elif self.ordered and subgraph not in first_nodes:
+				first_nodes[subgraph] = name
+
+			subgraphs[subgraph].add_node(name, fillcolor=color, label=label, shape=shape, style=style)
+
+			while edge_position == position:
+				tail_id, head_id, label, direction, subgraph = next(edges)
+				subgraphs[subgraph].add_edge(str(tail_id), str(head_id), dir=direction, **{label_attribute: label})
+				edge_position = next(edge_positions, None)
+
+		# Add final node on right-hand-side to complete left-right ordering
+		if self.ordered:
+			agraph.add_node('end', label='', style='invis', width=0)
+			ordering.add_edge(order_id, 'end', style='invis')
+
+		return agraph
+
+
+class NullGraph:
+	# Stands in for a GraphIR when no graphs are wanted, discarding everything added to it
+	__slots__ = ()
+
+	def add_subgraph(self, parent, name=None, **attributes):
+		return 0
+
+	def add_node(self, subgraph, node_id, label, color='', shape='', style='filled'):
+		pass
+
+	def add_edge(self, subgraph, tail_id, head_id, label='', direction=''):
+		pass
+
+	def add_root(self, node_id, group=None):
+		pass
@@ -0,0 +1,457 @@
+#!/usr/bin/env python3
+
+# Self-contained HTML viewer for large graphs, written straight from a GraphIR without graphviz. The graph is split into
+# chunks (each top-level declaration of an AST, or each expression or other top-level cluster), listed by function.
+# Each chunk is embedded as JSON that is only parsed, laid out (as a tree, in the browser) and drawn as SVG when it is
+# opened, with the clusters inside it collapsed until they are expanded. Generation is a single pass over the graph.
+
+import html
+import json
+
+
+def top_clusters(graph):
+	# The top-level cluster containing each subgraph (0 for the graph itself)
+	top = [0] * len(graph.subgraph_parents)
+	for subgraph, parent in enumerate(graph.subgraph_parents):
+		if subgraph > 0:
+			top[subgraph] = subgraph if parent == 0 else top[parent]
+	return top
+
+
+def tree_edges(graph, rows, top):
+	# Each node's edge to its parent is added along with it, so is the first edge added after it that joins it to
+	# another node. Roots (e.g. of expressions) have no parent, and edges between different top-level clusters (e.g. to
+	# shared subexpressions, or from definitions to uses) are cross links rather than part of the tree.
+	roots = set(graph.roots)
+	parents = {}
+	links = []
+	for edge, (tail_id, head_id, position) in enumerate(zip(graph.edge_tails, graph.edge_heads, graph.edge_positions)):
+		owner = graph.node_ids[position - 1] if position > 0 else None
+		if owner in (tail_id, head_id) and owner not in parents and owner not in roots and tail_id != head_id:
+			other = head_id if owner == tail_id else tail_id
+			if other in rows:
+				owner_top = top[graph.node_subgraphs[rows[owner]]]
+				other_top = top[graph.node_subgraphs[rows[other]]]
+				if not owner_top or not other_top or owner_top == other_top:
+					parents[owner] = (other, edge)
+					continue
+		if tail_id in rows and head_id in rows:
+			links.append(edge)
+	return parents, links
+
+
+def first_line(label):
+	return str(label).split('\n', 1)[0]
+
+
+def declared_name(graph, rows, node_ids):
+	# The name given in the first few labels of a chunk (e.g. a function definition's declaration)
+	for node_id in node_ids[:3]:
+		for line in str(graph.node_labels[rows[node_id]]).split('\n')[1:]:
+			if line.startswith('name: '):
+				return line[6:]
+	return None
+
+
+def viewer_chunks(graph):
+	# Split a graph into chunks, returning the node ids in each (in tree pre-order), along with each node's tree parent
+	# and the edges linking nodes in different chunks
+	rows = {node_id: row for row, node_id in enumerate(graph.node_ids)}
+	roots = set(graph.roots)
+	top = top_clusters(graph)
+	parents, links = tree_edges(graph, rows, top)
+	children = {}
+	for node_id in graph.node_ids:
+		if node_id in parents:
+			children.setdefault(parents[node_id][0], []).append(node_id)
+
+	# A tree's root outside any cluster whose children are all list items (e.g. a FileAST, but not a FuncDef) just
+	# contains its children's chunks, and trees in a top-level cluster share its chunk
+	keys = {}
+	chunks = []
+	containers = set()
+	for node_id in graph.node_ids:
+		if node_id in parents:
+			continue
+		cluster = top[graph.node_subgraphs[rows[node_id]]]
+		starts = [node_id]
+		if (not cluster and node_id not in roots and node_id in children and
+		        all(graph.edge_labels[parents[child][1]].endswith(']') for child in children[node_id])):
+			containers.add(node_id)
+			starts = children[node_id]
+		for start in starts:
+			key = ('cluster', cluster) if cluster else ('tree', start)
+			if key not in keys:
+				keys[key] = len(chunks)
+				chunks.append((key, []))
+			nodes = chunks[keys[key]][1]
+			stack = [start]
+			while stack:
+				current = stack.pop()
+				nodes.append(current)
+				stack.extend(reversed(children.get(current, [])))
+	return rows, top, parents, links, chunks, containers
+
+
+def write_viewer(graph, output, title=''):
+	# Write the viewer for a graph to an HTML file
+	rows, top, parents, links, chunks, containers = viewer_chunks(graph)
+	chunk_of = {node_id: index for index, (_, nodes) in enumerate(chunks) for node_id in nodes}
+	root_groups = dict(zip(graph.roots, graph.root_groups))
+
+	# Cross links are listed with both of the chunks they join
+	chunk_links = {}
+	for edge in links:
+		tail_id, head_id = graph.edge_tails[edge], graph.edge_heads[edge]
+		if tail_id in chunk_of and head_id in chunk_of:
+			link = [tail_id, head_id, graph.edge_labels[edge], graph.edge_directions[edge]]
+			chunk_links.setdefault(chunk_of[tail_id], []).append(link + [chunk_of[head_id]])
+			if chunk_of[head_id] != chunk_of[tail_id]:
+				chunk_links.setdefault(chunk_of[head_id], []).append(link + [chunk_of[tail_id]])
+
+	groups = {}
+	index = []
+	with open(output, 'w') as f:
+		f.write(HEADER.replace('$TITLE', html.escape(title)))
+		for number, ((kind, key), nodes) in enumerate(chunks):
+			# Clusters within the chunk are numbered locally, and nodes refer to their parent by position in the chunk
+			clusters = {}
+			cluster_table = []
+
+			def local_cluster(subgraph):
+				if subgraph == 0 or (kind == 'cluster' and subgraph == key):
+					return -1
+				if subgraph not in clusters:
+					parent = local_cluster(graph.subgraph_parents[subgraph])
+					attributes = graph.subgraph_attributes[subgraph]
+					clusters[subgraph] = len(cluster_table)
+					cluster_table.append([attributes.get('label', ''), attributes.get('style', ''), parent])
+				return clusters[subgraph]
+
+			positions = {node_id: position for position, node_id in enumerate(nodes)}
+			table = []
+			for node_id in nodes:
+				row = rows[node_id]
+				parent_id, edge = parents.get(node_id, (None, None))
+				node = [node_id, graph.node_labels[row], graph.node_colors[row], graph.node_shapes[row],
+				        graph.node_styles[row], local_cluster(graph.node_subgraphs[row])]
+				if parent_id in positions:
+					node += [positions[parent_id], graph.edge_labels[edge], graph.edge_directions[edge],
+					         int(graph.edge_tails[edge] == node_id)]
+				table.append(node)
+
+			# Expressions are listed by function, and declarations by name
+			if kind == 'cluster':
+				chunk_title = graph.subgraph_attributes[key].get('label', '')
+				if nodes[0] in root_groups:
+					chunk_title += '  ' + first_line(graph.node_labels[rows[nodes[0]]])
+				group = next((root_groups[node_id] for node_id in nodes if node_id in root_groups), None)
+				group = group or ('file scope' if graph.roots else '')
+			else:
+				name = declared_name(graph, rows, nodes)
+				chunk_title = first_line(graph.node_labels[rows[nodes[0]]]) + (f' {name}' if name else '')
+				group = chunk_title
+			if group not in groups:
+				groups[group] = len(index)
+				index.append([group, []])
+			index[groups[group]][1].append([number, chunk_title, len(nodes)])
+
+			data = json.dumps({'nodes': table, 'clusters': cluster_table, 'links': chunk_links.get(number, [])})
+			f.write(f'<script type="application/json" id="chunk{number}">{script_text(data)}</script>\n')
+
+		data = json.dumps({'title': title, 'groups': index, 'nodes': len(graph.node_ids),
+		                   'hidden': [first_line(graph.node_labels[rows[node_id]]) for node_id in containers]})
+		f.write(f'<script type="application/json" id="index">{script_text(data)}</script>\n')
+		f.write(FOOTER)
+
+
+def script_text(data):
+	# Keep embedded JSON from closing its script element
+	return data.replace('</', '<\\/')
+
+
+HEADER = '''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>$TITLE</title>
+<style>
+body { font-family: sans-serif; margin: 0; display: flex; height: 100vh; }
+#side { width: 22em; overflow: auto; border-right: 1px solid #ccc; padding: 0.5em; font-size: 13px; flex: none; }
+#main { flex: 1; overflow: auto; padding: 0.5em; }
+#side details { margin: 0.2em 0; }
+#side summary { cursor: pointer; font-weight: bold; }
+.chunk { display: block; cursor: pointer; padding: 1px 0 1px 1.2em; white-space: nowrap; }
+.chunk.open { background: #dde8ff; }
+.size { color: #888; }
+.panel { border: 1px solid #ccc; margin-bottom: 1em; }
+.panel h3 { margin: 0; padding: 0.3em; background: #f4f4f4; font-size: 14px; cursor: pointer; }
+.panel .links { padding: 0.3em; font-size: 12px; }
+.panel .links a { margin-right: 1em; cursor: pointer; color: #03c; }
+svg text { font-family: Times, serif; font-size: 14px; }
+svg .cluster { cursor: pointer; }
+svg .hl > :first-child { stroke: red; stroke-width: 3; }
+</style>
+</head>
+<body>
+<div id="side"></div>
+<div id="main"></div>
+'''
+
+FOOTER = '''<script>
+'use strict';
+const index = JSON.parse(document.getElementById('index').textContent);
+const chunks = {};
+const panels = {};
+const side = document.getElementById('side');
+const main = document.getElementById('main');
+const NS = 'http://www.w3.org/2000/svg';
+
+// Chunks are only parsed from their script element the first time they are opened
+function chunk(number) {
+	if (!(number in chunks)) {
+		const data = JSON.parse(document.getElementById('chunk' + number).textContent);
+		data.collapsed = data.clusters.map(() => true);
+		chunks[number] = data;
+	}
+	return chunks[number];
+}
+
+function element(name, attributes, parent) {
+	const e = document.createElementNS(NS, name);
+	for (const key in attributes) e.setAttribute(key, attributes[key]);
+	if (parent) parent.appendChild(e);
+	return e;
+}
+
+function lines(label) {
+	return String(label).replace(/\\\\([<>])/g, '$1').split('\\n');
+}
+
+// A node's visible box: collapsed clusters are drawn as a single node in place of the subtree they start
+function box(data, node, cluster) {
+	const text = cluster >= 0 ? [lines(node[1])[0], data.clusters[cluster][0], '(' + data.counts[cluster] + ' nodes)']
+	                          : lines(node[1]);
+	const width = Math.max(...text.map(line => line.length)) * 7.5 + 20;
+	return {text: text, width: width, height: text.length * 16 + 12};
+}
+
+// The outermost collapsed cluster containing a node, if any
+function collapsedCluster(data, cluster) {
+	let found = -1;
+	for (; cluster >= 0; cluster = data.clusters[cluster][2]) {
+		if (data.collapsed[cluster]) found = cluster;
+	}
+	return found;
+}
+
+// Lay out the visible tree top-down, each subtree given the width of its widest row of leaves or its own node, and
+// each depth a row as tall as its tallest node. Iterative, so deep expressions are laid out in linear time.
+function layout(data) {
+	const nodes = data.nodes;
+	const children = nodes.map(() => []);
+	const roots = [];
+	nodes.forEach((node, i) => (node.length > 6 ? children[node[6]] : roots).push(i));
+	data.counts = data.clusters.map(() => 0);
+	nodes.forEach(node => {
+		for (let c = node[5]; c >= 0; c = data.clusters[c][2]) data.counts[c]++;
+	});
+
+	// Nodes inside a collapsed cluster are hidden, apart from the first, which stands for the whole cluster
+	const visible = [], depth = {}, shown = {}, heights = [];
+	const stack = roots.slice().reverse().map(i => [i, 0]);
+	while (stack.length) {
+		const [i, d] = stack.pop();
+		const cluster = collapsedCluster(data, nodes[i][5]);
+		shown[i] = box(data, nodes[i], cluster);
+		shown[i].cluster = cluster;
+		shown[i].children = [];
+		if (nodes[i].length > 6) shown[nodes[i][6]].children.push(i);
+		depth[i] = d;
+		heights[d] = Math.max(heights[d] || 0, shown[i].height);
+		visible.push(i);
+		if (cluster < 0) {
+			for (let c = children[i].length - 1; c >= 0; c--) stack.push([children[i][c], d + 1]);
+		}
+	}
+
+	const tops = [10];
+	for (let d = 0; d < heights.length; d++) tops.push(tops[d] + heights[d] + 50);
+	for (let v = visible.length - 1; v >= 0; v--) {
+		const s = shown[visible[v]];
+		s.span = s.children.reduce((total, c) => total + shown[c].span, 15 * (s.children.length - 1));
+		s.span = Math.max(s.span, s.width);
+	}
+	let cursor = 10;
+	for (const i of roots) {
+		shown[i].left = cursor;
+		cursor += shown[i].span + 15;
+	}
+	for (const i of visible) {
+		const s = shown[i];
+		s.x = s.left + s.span / 2;
+		s.y = tops[depth[i]] + (heights[depth[i]] - s.height) / 2;
+		let left = s.left + (s.span - s.children.reduce((total, c) => total + shown[c].span + 15, -15)) / 2;
+		for (const c of s.children) {
+			shown[c].left = left;
+			left += shown[c].span + 15;
+		}
+	}
+	return {visible: visible, shown: shown, width: cursor, height: tops[heights.length] || 40};
+}
+
+function arrow(svg, x1, y1, x2, y2, attributes, head, tail) {
+	const line = element('line', Object.assign({x1: x1, y1: y1, x2: x2, y2: y2, stroke: 'black'}, attributes), svg);
+	if (head) line.setAttribute('marker-end', 'url(#arrow)');
+	if (tail) line.setAttribute('marker-start', 'url(#arrow)');
+	return line;
+}
+
+function draw(number) {
+	const data = chunk(number);
+	const panel = panels[number];
+	const {visible, shown, width, height} = layout(data);
+	const svg = element('svg', {width: width, height: height});
+	const defs = element('defs', {}, svg);
+	const marker = element('marker', {id: 'arrow', viewBox: '0 0 10 10', refX: 10, refY: 5, markerWidth: 8,
+	                                  markerHeight: 8, orient: 'auto-start-reverse'}, defs);
+	element('path', {d: 'M 0 0 L 10 5 L 0 10 z'}, marker);
+
+	for (const i of visible) {
+		const node = data.nodes[i];
+		if (node.length <= 6 || !(node[6] in shown)) continue;
+		const parent = shown[node[6]], child = shown[i];
+		const direction = node[8], inverted = node[9];
+		const head = direction === 'forward' || direction === 'both', tail = direction === 'back' || direction === 'both';
+		// Arrows are drawn at the head or tail of the edge as added, which may run from child to parent
+		arrow(svg, parent.x, parent.y + parent.height, child.x, child.y,
+		      {}, inverted ? tail : head, inverted ? head : tail);
+		if (node[7]) {
+			const label = element('text', {x: (parent.x + child.x) / 2 + 4, y: (parent.y + parent.height + child.y) / 2,
+			                               'font-size': 11}, svg);
+			label.textContent = node[7];
+		}
+	}
+
+	for (const i of visible) {
+		const node = data.nodes[i], s = shown[i];
+		const g = element('g', {id: 'n' + number + '-' + node[0]}, svg);
+		const style = String(node[4] || '');
+		const attributes = {fill: s.cluster >= 0 ? '#eee' : (style.includes('filled') ? node[2] || 'lightgrey' : 'none'),
+		                    stroke: 'black', 'stroke-width': style.includes('bold') ? 2 : 1};
+		if (style.includes('dashed') || (s.cluster >= 0 && data.clusters[s.cluster][1] === 'dashed')) {
+			attributes['stroke-dasharray'] = '5,3';
+		}
+		if (s.cluster >= 0 || node[3] === 'square' || node[3] === 'box') {
+			element('rect', Object.assign({x: s.x - s.width / 2, y: s.y, width: s.width, height: s.height}, attributes), g);
+		} else {
+			element('ellipse', Object.assign({cx: s.x, cy: s.y + s.height / 2, rx: s.width / 2, ry: s.height / 2},
+			                                 attributes), g);
+		}
+		s.text.forEach((line, l) => {
+			const text = element('text', {x: s.x, y: s.y + 20 + l * 16, 'text-anchor': 'middle'}, g);
+			text.textContent = line;
+		});
+		const cluster = s.cluster >= 0 ? s.cluster : node[5];
+		if (cluster >= 0) {
+			g.setAttribute('class', 'cluster');
+			const title = element('title', {}, g);
+			title.textContent = (data.collapsed[cluster] ? 'Expand ' : 'Collapse ') + (data.clusters[cluster][0] || 'cluster');
+			g.addEventListener('click', () => {
+				data.collapsed[cluster] = !data.collapsed[cluster];
+				draw(number);
+			});
+		}
+	}
+
+	panel.body.replaceChildren(svg);
+	panel.links.replaceChildren();
+	for (const [tail, head, label, direction, other] of data.links) {
+		const a = document.createElement('a');
+		a.textContent = tail + ' \\u2192 ' + head + (label ? ' (' + label + ')' : '') +
+		                (other !== number ? ' in ' + title(other) : '');
+		// Links lead to whichever end is in the other chunk
+		const target = other === number || data.nodes.some(n => n[0] === tail) ? head : tail;
+		a.addEventListener('click', () => show(other, target));
+		panel.links.appendChild(a);
+	}
+}
+
+const titles = {};
+function title(number) {
+	return titles[number];
+}
+
+function open(number) {
+	if (!(number in panels)) {
+		const div = document.createElement('div');
+		div.className = 'panel';
+		const h = document.createElement('h3');
+		h.textContent = title(number) + ' \\u2715';
+		h.addEventListener('click', () => close(number));
+		const body = document.createElement('div');
+		const links = document.createElement('div');
+		links.className = 'links';
+		div.append(h, body, links);
+		main.appendChild(div);
+		panels[number] = {div: div, body: body, links: links};
+		draw(number);
+		document.getElementById('entry' + number).classList.add('open');
+	}
+	return panels[number];
+}
+
+function close(number) {
+	panels[number].div.remove();
+	delete panels[number];
+	document.getElementById('entry' + number).classList.remove('open');
+}
+
+// Open a chunk, expanding any collapsed clusters around a node in it, and scroll to that node
+function show(number, nodeId) {
+	const data = chunk(number);
+	const node = data.nodes.find(n => n[0] === nodeId);
+	if (node) {
+		for (let c = node[5]; c >= 0; c = data.clusters[c][2]) data.collapsed[c] = false;
+	}
+	const panel = number in panels ? panels[number] : open(number);
+	draw(number);
+	const g = document.getElementById('n' + number + '-' + nodeId);
+	(g || panel.div).scrollIntoView({block: 'center'});
+	if (g) g.classList.add('hl');
+}
+
+const heading = document.createElement('div');
+heading.innerHTML = '<b></b><br><span class="size"></span>';
+heading.firstChild.textContent = index.title;
+heading.lastChild.textContent = index.nodes + ' nodes' + (index.hidden.length ? ', in ' + index.hidden.join(', ') : '');
+side.appendChild(heading);
+for (const [group, entries] of index.groups) {
+	const details = document.createElement('details');
+	const summary = document.createElement('summary');
+	summary.textContent = (group || 'graph') + ' ';
+	const size = document.createElement('span');
+	size.className = 'size';
+	size.textContent = '(' + entries.length + ')';
+	summary.appendChild(size);
+	details.appendChild(summary);
+	for (const [number, chunkTitle, nodes] of entries) {
+		titles[number] = chunkTitle;
+		const entry = document.createElement('span');
+		entry.className = 'chunk';
+		entry.id = 'entry' + number;
+		entry.textContent = chunkTitle + ' ';
+		const count = document.createElement('span');
+		count.className = 'size';
+		count.textContent = nodes;
+		entry.appendChild(count);
+		entry.addEventListener('click', () => number in panels ? close(number) : show(number, null));
+		details.appendChild(entry);
+	}
+	side.appendChild(details);
+}
+if (index.groups.length === 1) side.querySelector('details').open = true;
+</script>
+</body>
+</html>
+'''
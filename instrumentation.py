@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+# Timing of pipeline stages, counters and peak memory, reported as JSON or passed to a hook as each stage completes
+
+import collections
+import contextlib
+import sys
+import time
+
+try:
+	import resource
+except ImportError:
+	resource = None
+
+
+def peak_memory():
+	# Peak resident set size of this process in bytes, since it was last reset where that is possible, where the
+	# platform reports it
+	try:
+		with open('/proc/self/status') as f:
+			for line in f:
+				if line.startswith('VmHWM:'):
+					return int(line.split()[1]) * 1024
+	except OSError:
+		pass
+	if resource is None:
+		return None
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def reset_peak_memory():
+	# Start measuring peak memory afresh, so that a worker process reused for several files reports each one's own peak.
+	# Only Linux can reset it, elsewhere the peak stays that of the whole process.
+	try:
+		with open('/proc/self/clear_refs', 'w') as f:
+			f.write('5')
+	except OSError:
+		pass
+
+
+class Instrumentation:
+	def __init__(self, hook=None):
+		# The hook, if given, is called with the name, wall time and CPU time of each stage as it completes
+		self.hook = hook
+		self.stages = {}
+		self.counters = collections.Counter()
+		self.peak_memory = None
+
+	@contextlib.contextmanager
+	def stage(self, name):
+		wall, cpu = time.perf_counter(), time.process_time()
+		try:
+			yield
+		finally:
+			wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+			totals = self.stages.setdefault(name, [0.0, 0.0])
+			totals[0] += wall
+			totals[1] += cpu
+			peak = peak_memory()
+			if peak is not None:
+				self.peak_memory = max(self.peak_memory or 0, peak)
+			if self.hook is not None:
+				self.hook(name, wall, cpu)
+
+	def count(self, name, value=1):
+		self.counters[name] += value
+
+	def merge(self, other):
+		# Add the stages and counters of another instrumentation (e.g. returned from a worker process) to this one
+		for name, (wall, cpu) in other.stages.items():
+			totals = self.stages.setdefault(name, [0.0, 0.0])
+			totals[0] += wall
+			totals[1] += cpu
+		self.counters.update(other.counters)
+		if other.peak_memory is not None:
+			self.peak_memory = max(self.peak_memory or 0, other.peak_memory)
+
+	def __getstate__(self):
+		# Hooks stay in the process they were set up in
+		return {'hook': None, 'stages': self.stages, 'counters': self.counters, 'peak_memory': self.peak_memory}
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+
+	def report(self):
+		return {
+			'stages': {name: {'wall': round(wall, 6), 'cpu': round(cpu, 6)} for name, (wall, cpu) in self.stages.items()},
+			'counters': dict(self.counters),
+			'peak_memory': self.peak_memory,
+		}
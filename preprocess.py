@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+
+# Fast path for preprocessing C source without running cpp. Files with no preprocessor directives and no predefined
+# macros only need comments removing and whitespace normalising, which is done here exactly as GNU cpp would (so that
+# coordinates in the parsed AST are identical). Anything else falls back to running cpp, whose output can be cached.
+
+import os
+import re
+
+TOKENS = re.compile(r'''
+	(?P<newline>\n)
+	|(?P<splice>\\\n)
+	|(?P<space>[ \t\f\v\r]+)
+	|(?P<block>/\*.*?\*/)
+	|(?P<line>//(?:\\\n|[^\n])*)
+	|(?P<string>(?:u8|[LuU])?"(?:\\[^\n]|[^"\\\n])*")
+	|(?P<char>(?:u8|[LuU])?'(?:\\[^\n]|[^'\\\n])*')
+	|(?P<number>\.?[0-9](?:[eEpP][+-]|[.\w])*)
+	|(?P<identifier>[A-Za-z_]\w*)
+	|(?P<directive>\#|%:|\?\?)
+	|(?P<other>.)
+''', re.VERBOSE | re.DOTALL)
+
+# Bump when the layout of cached preprocessed source changes, to invalidate old cache entries
+CACHE_VERSION = 1
+
+# Macros older compilers (and GCC in its default GNU mode) define outside the reserved namespace
+SYSTEM_MACROS = {'unix', 'linux', 'i386', 'sun', 'sparc', 'mips', 'vax', 'pdp11', 'mc68000', 'm68k', 'hppa', 'sgi',
+                 'MIPSEB', 'MIPSEL', 'R3000', 'R4000', 'host_mips', 'bsd4_3', 'bsd4_4'}
+
+
+def reserved(identifier):
+	# Predefined macros (e.g. __FILE__, _WIN32) are reserved identifiers, apart from traditional names for the system
+	return (identifier.startswith('__') or (identifier[0] == '_' and identifier[1:2].isupper()) or
+	        identifier in SYSTEM_MACROS)
+
+
+def fast_preprocess(text):
+	# Return the text cpp would produce (less its line markers), or None if cpp is really needed. As in cpp, the first
+	# token of each logical line goes on its physical line, indented to its column. Later tokens stay on the same output
+	# line unless whitespace or a comment separates them from the previous token, in which case they either follow a
+	# single space or, if a line splice or comment has moved them onto a later physical line, start a new line.
+	output = []
+	output_line = line = 1
+	line_start = 0
+	start = True
+	space = False
+	for match in TOKENS.finditer(text):
+		kind = match.lastgroup
+		value = match.group()
+		if kind == 'newline':
+			line += 1
+			line_start = match.end()
+			start = True
+			space = False
+		elif kind in ('space', 'splice', 'line', 'block'):
+			if kind == 'splice' and not (text[match.start() - 1:match.start()].isspace() or
+			                             text[match.end():match.end() + 1].isspace()):
+				# A splice may join the parts of a single token
+				return None
+			if '\n' in value:
+				line += value.count('\n')
+				line_start = match.start() + value.rindex('\n') + 1
+			space = space or kind != 'splice'
+		elif kind == 'directive' or (kind == 'identifier' and reserved(value)):
+			return None
+		elif kind in ('string', 'char') and '\\\n' in value:
+			return None
+		else:
+			if start or (space and line != output_line):
+				output.append('\n' * (line - output_line))
+				output.append(' ' * (max(match.start() - line_start - 1, 0) + space))
+				output_line = line
+			elif space:
+				output.append(' ')
+			start = False
+			space = False
+			output.append(value)
+
+	output.append('\n')
+	return ''.join(output)
+
+
+def run_cpp(source_filename, cpp_path='cpp', cpp_args='', dependencies=None):
+	# Run cpp as pycparser.preprocess_file does, optionally also writing every file it reads to a make-style
+	# dependency file (with GCC or Clang's -MD -MF)
+	import subprocess
+
+	arguments = [cpp_path] + (cpp_args if isinstance(cpp_args, list) else [cpp_args] if cpp_args != '' else [])
+	if dependencies is not None:
+		arguments += ['-MD', '-MF', dependencies]
+	try:
+		return subprocess.check_output(arguments + [source_filename], universal_newlines=True)
+	except OSError as e:
+		raise RuntimeError(f"Unable to invoke '{cpp_path}'.  Make sure its path was passed correctly\n"
+		                   f"Original error: {e}")
+
+
+def read_dependencies(path):
+	# Read the files listed in a make-style dependency file, after the target
+	with open(path) as f:
+		text = f.read().replace('\\\n', ' ')
+	_, _, text = text.partition(': ')
+	return [name.replace('\\ ', ' ').replace('$$', '$') for name in re.split(r'(?<!\\)\s+', text) if name]
+
+
+def file_state(path):
+	try:
+		stat = os.stat(path)
+	except OSError:
+		return None
+	return stat.st_mtime_ns, stat.st_size
+
+
+class PreprocessCache:
+	# On-disk cache of preprocessed source, kept alongside cached ASTs and evicted with them. Entries are keyed by the
+	# file, the working directory, cpp and its arguments, and are used while the file and every header it included are
+	# unchanged (by modification time and size).
+	def __init__(self, directory):
+		self.directory = directory
+
+	def key(self, source_filename, cpp_path='cpp', cpp_args=''):
+		import hashlib
+
+		digest = hashlib.sha256()
+		for part in (str(CACHE_VERSION), os.getcwd(), os.path.abspath(source_filename), cpp_path, repr(cpp_args or [])):
+			digest.update(part.encode() + b'\0')
+		return digest.hexdigest()
+
+	def path(self, key):
+		return os.path.join(self.directory, key[:2], key + '.cpp')
+
+	def load(self, key):
+		import marshal
+		import zlib
+
+		path = self.path(key)
+		try:
+			with open(path, 'rb') as f:
+				version, files, text = marshal.loads(zlib.decompress(f.read()))
+		except (OSError, ValueError, EOFError, TypeError, zlib.error):
+			return None
+		if version != CACHE_VERSION or any(file_state(name) != tuple(state) for name, state in files):
+			return None
+
+		# Record the access time ourselves, as file systems are often mounted without atime updates
+		try:
+			os.utime(path)
+		except OSError:
+			pass
+		return text
+
+	def preprocess(self, key, source_filename, cpp_path='cpp', cpp_args=''):
+		# Run cpp and store its output, along with the state of every file it read. Entries are not stored if any of
+		# those files has since been removed.
+		import marshal
+		import zlib
+
+		path = self.path(key)
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		temporary = f"{path}.{os.getpid()}.{id(self)}.tmp"
+		try:
+			text = run_cpp(source_filename, cpp_path, cpp_args, temporary + '.d')
+			files = [(os.path.abspath(name), file_state(name)) for name in read_dependencies(temporary + '.d')]
+		finally:
+			if os.path.exists(temporary + '.d'):
+				os.remove(temporary + '.d')
+		if all(state is not None for _, state in files):
+			# Write to a temporary file and rename it into place, so concurrent readers never see partial entries
+			with open(temporary, 'wb') as f:
+				f.write(zlib.compress(marshal.dumps((CACHE_VERSION, files, text))))
+			os.replace(temporary, path)
+		return text
+
+
+def preprocess(source_filename, cpp_path='cpp', cpp_args='', fast=False, cache=None):
+	# Preprocess a file, trying the fast path first if enabled, then any cache. Returns the text and how it was
+	# produced: 'fast', 'cache' or 'cpp'.
+	if fast and not cpp_args:
+		with open(source_filename) as f:
+			text = fast_preprocess(f.read())
+		if text is not None:
+			return text, 'fast'
+	if cache is not None:
+		key = cache.key(source_filename, cpp_path, cpp_args)
+		text = cache.load(key)
+		if text is not None:
+			return text, 'cache'
+		return cache.preprocess(key, source_filename, cpp_path, cpp_args), 'cpp'
+	return run_cpp(source_filename, cpp_path, cpp_args), 'cpp'
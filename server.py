@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+
+# Long-running extraction server for editor integrations, avoiding start-up and import costs on every request. Requests
+# are JSON over HTTP, on a localhost port or a Unix socket. Each runs in a worker process forked from a fork server that
+# has already imported the parser and graphviz, with a fixed number running at once, the rest queued, and any request
+# cancellable by its id.
+
+import argparse
+import base64
+import contextlib
+import http.server
+import io
+import json
+import multiprocessing
+import os
+import queue
+import shutil
+import signal
+import socketserver
+import sys
+import tempfile
+import threading
+import uuid
+
+import expressions
+from instrumentation import Instrumentation
+
+# Options the server sets itself for each request
+SERVER_OPTIONS = ('ast', 'expressions', 'data_flow', 'store', 'output', 'compile_commands', 'render', 'stats')
+
+
+class RequestError(Exception):
+	def __init__(self, status, message):
+		super().__init__(message)
+		self.status = status
+
+
+def run_request(connection, job, directory):
+	# Run a job in a worker process, sending back any error, its statistics and anything it printed. Inline source is
+	# written to the request's directory, so it is run from there to keep its file name as given.
+	os.chdir(directory)
+	instrumentation = Instrumentation()
+	log = io.StringIO()
+	error = None
+	try:
+		with contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+			expressions.run_job(job, instrumentation)
+	except Exception as e:
+		error = '{}: {}'.format(type(e).__name__, e)
+	connection.send((error, instrumentation.report(), log.getvalue()))
+
+
+class Request:
+	def __init__(self, request_id, job, directory, timeout=None):
+		self.id = request_id
+		self.job = job
+		self.directory = directory
+		self.timeout = timeout
+		self.state = 'queued'
+		self.process = None
+		self.result = None
+		self.finished = threading.Event()
+
+	def finish(self, state, result):
+		self.state = state
+		self.result = result
+		self.finished.set()
+
+
+class ExtractionServer:
+	def __init__(self, workers=1, queue_size=64, verbosity=0):
+		# Workers are forked from a fork server with the expensive modules already imported, so start quickly and can
+		# be killed to cancel a running request
+		self.context = multiprocessing.get_context('forkserver')
+		self.context.set_forkserver_preload(['expressions', 'pygraphviz', 'pycparser', 'pycparser.c_ast'])
+		self.verbosity = verbosity
+		self.queue = queue.Queue(queue_size)
+		self.requests = {}
+		self.lock = threading.Lock()
+		for _ in range(workers):
+			threading.Thread(target=self.dispatch, daemon=True).start()
+
+	def job(self, body, directory):
+		# Build a job from a request's file path or inline source and its command line options, with outputs in the
+		# request's directory
+		parser = expressions.argument_parser()
+		errors = io.StringIO()
+		try:
+			with contextlib.redirect_stderr(errors):
+				options = parser.parse_args([str(arg) for arg in body.get('args', [])])
+				expressions.check_arguments(parser, options)
+		except SystemExit:
+			raise RequestError(400, errors.getvalue().strip().splitlines()[-1])
+		if options.source_files or any(getattr(options, option) not in (None, False) for option in SERVER_OPTIONS):
+			raise RequestError(400, 'source files and output options are set by the server, use "path" or "source" '
+			                        'and "outputs"')
+
+		# The cache and index are shared between requests, so are found from the server's directory rather than the
+		# request's
+		for option in ('cache', 'index'):
+			if getattr(options, option) is not None:
+				setattr(options, option, os.path.abspath(getattr(options, option)))
+
+		if 'source' in body:
+			source_filename = os.path.basename(body.get('filename', 'source.c'))
+			with open(os.path.join(directory, source_filename), 'w') as f:
+				f.write(body['source'])
+		elif 'path' in body:
+			source_filename = os.path.abspath(body['path'])
+			if not os.path.isfile(source_filename):
+				raise RequestError(400, f"no such file '{body['path']}'")
+		else:
+			raise RequestError(400, 'request has neither "path" nor "source"')
+
+		# Graphs are output as DOT unless PNG is asked for
+		outputs = body.get('outputs', ['ast', 'expressions'])
+		if not options.png:
+			options.dot = True
+		cpp_args = [options.cppargs] if options.cppargs != '' else ''
+		return expressions.Job(source_filename, cpp_args,
+		                       os.path.join(directory, 'ast') if 'ast' in outputs else None,
+		                       os.path.join(directory, 'expressions') if 'expressions' in outputs else None,
+		                       os.path.join(directory, 'records.jsonl'), options,
+		                       os.path.join(directory, 'data_flow') if 'data_flow' in outputs else None,
+		                       os.path.join(directory, 'extraction.store') if 'store' in outputs else None)
+
+	def submit(self, body):
+		request_id = str(body.get('id') or uuid.uuid4())
+		directory = tempfile.mkdtemp(prefix='expressions-server-')
+		try:
+			timeout = body.get('timeout')
+			if timeout is not None and (isinstance(timeout, bool) or not isinstance(timeout, (int, float))
+			                            or not 0 < timeout < float('inf')):
+				raise RequestError(400, '"timeout" must be a positive number of seconds')
+			request = Request(request_id, self.job(body, directory), directory, timeout)
+			with self.lock:
+				if request_id in self.requests:
+					raise RequestError(409, f"request '{request_id}' already exists")
+				self.requests[request_id] = request
+			try:
+				self.queue.put_nowait(request)
+			except queue.Full:
+				with self.lock:
+					del self.requests[request_id]
+				raise RequestError(503, 'too many requests queued')
+		except BaseException:
+			shutil.rmtree(directory, ignore_errors=True)
+			raise
+		return request
+
+	def wait(self, request):
+		# Wait for a request to finish, returning its HTTP status and response, and forgetting it
+		request.finished.wait()
+		with self.lock:
+			self.requests.pop(request.id, None)
+		try:
+			if request.state == 'done':
+				error, stats, log = request.result
+				if error is not None:
+					return 422, {'id': request.id, 'status': 'failed', 'error': error, 'log': log}
+				return 200, {'id': request.id, 'status': 'done', 'files': read_outputs(request.directory, request.job),
+				             'stats': stats, 'log': log}
+			return 409, {'id': request.id, 'status': request.state, 'error': request.result}
+		finally:
+			shutil.rmtree(request.directory, ignore_errors=True)
+
+	def cancel(self, request_id):
+		# Queued requests are skipped when they reach a worker, and running ones have their worker process killed
+		with self.lock:
+			request = self.requests.get(request_id)
+			if request is None:
+				return None
+			if request.state == 'queued':
+				request.finish('cancelled', 'cancelled while queued')
+			elif request.state == 'running':
+				request.state = 'cancelling'
+				request.process.terminate()
+			return request.state
+
+	def status(self):
+		with self.lock:
+			return [{'id': request.id, 'status': request.state, 'source': request.job.source_filename}
+			        for request in self.requests.values()]
+
+	def dispatch(self):
+		while True:
+			request = self.queue.get()
+			# A request that fails to run is reported as failed, leaving this thread to run the next one
+			try:
+				self.run(request)
+			except Exception as e:
+				with self.lock:
+					if request.process is not None and request.process.is_alive():
+						request.process.terminate()
+					if not request.finished.is_set():
+						request.finish('failed', '{}: {}'.format(type(e).__name__, e))
+
+	def run(self, request):
+		with self.lock:
+			if request.state != 'queued':
+				return
+			receiver, sender = self.context.Pipe(duplex=False)
+			request.process = self.context.Process(target=run_request, args=(sender, request.job, request.directory))
+			request.state = 'running'
+			request.process.start()
+		sender.close()
+		if self.verbosity > 0:
+			print(f"Running request '{request.id}' for '{request.job.source_filename}'...", file=sys.stderr)
+
+		# A worker that exits without a result was killed, either by cancellation or for running out of time
+		result = None
+		try:
+			if receiver.poll(request.timeout):
+				try:
+					result = receiver.recv()
+				except EOFError:
+					pass
+		finally:
+			if result is None and request.process.is_alive():
+				request.process.terminate()
+			request.process.join()
+			receiver.close()
+
+		with self.lock:
+			if result is not None:
+				request.finish('done', result)
+			elif request.state == 'cancelling':
+				request.finish('cancelled', 'cancelled while running')
+			elif request.process.exitcode is not None and request.process.exitcode < 0 and request.timeout:
+				request.finish('timed out', f'no result after {request.timeout}s')
+			else:
+				request.finish('failed', f'worker exited with code {request.process.exitcode}')
+
+		# The cache is shared by every request, so is trimmed to its size after each one, once its result is ready
+		expressions.evict_cache(request.job.options)
+
+
+def read_outputs(directory, job):
+	# Return the files written for a request's outputs, by name, with PNG images and stores encoded as base64. Other
+	# files in its directory, such as its source, are left out, as is anything that is not a file of text.
+	outputs = [os.path.basename(path) for path in (job.ast_output, job.expressions_output, job.data_flow_output,
+	                                               job.store_output, job.records_output) if path is not None]
+	files = {}
+	for name in sorted(os.listdir(directory)):
+		path = os.path.join(directory, name)
+		if name == os.path.basename(job.source_filename) or not os.path.isfile(path):
+			continue
+		if not any(name == output or name.startswith(output + '.') for output in outputs):
+			continue
+		with open(path, 'rb') as f:
+			content = f.read()
+		if name.endswith(('.png', '.store')):
+			files[name] = base64.b64encode(content).decode()
+		else:
+			try:
+				files[name] = content.decode()
+			except UnicodeDecodeError:
+				continue
+	return files
+
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+	server_version = 'expressions'
+
+	def do_GET(self):
+		if self.path == '/health':
+			self.respond(200, {'status': 'ok'})
+		elif self.path == '/requests':
+			self.respond(200, {'requests': self.server.extraction.status()})
+		else:
+			self.respond(404, {'error': f"no such path '{self.path}'"})
+
+	def do_POST(self):
+		if self.path != '/extract':
+			self.respond(404, {'error': f"no such path '{self.path}'"})
+			return
+		try:
+			body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+			if not isinstance(body, dict):
+				raise RequestError(400, 'request must be a JSON object')
+			request = self.server.extraction.submit(body)
+		except ValueError as error:
+			self.respond(400, {'error': f'invalid JSON: {error}'})
+			return
+		except RequestError as error:
+			self.respond(error.status, {'error': str(error)})
+			return
+		self.respond(*self.server.extraction.wait(request))
+
+	def do_DELETE(self):
+		request_id = self.path[len('/requests/'):]
+		state = self.server.extraction.cancel(request_id) if self.path.startswith('/requests/') else None
+		if state is not None:
+			self.respond(200, {'id': request_id, 'status': state})
+		else:
+			self.respond(404, {'error': f"no such request '{request_id}'"})
+
+	def respond(self, status, body):
+		content = json.dumps(body).encode()
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(content)))
+		self.end_headers()
+		self.wfile.write(content)
+
+	def log_message(self, format, *args):
+		if self.server.extraction.verbosity > 0:
+			super().log_message(format, *args)
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+	daemon_threads = True
+
+	def get_request(self):
+		# Unix socket clients have no address, which the request handler expects
+		request, _ = super().get_request()
+		return request, ('local', 0)
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Serve expression extraction requests over HTTP.')
+	listen = parser.add_mutually_exclusive_group(required=True)
+	listen.add_argument('-s', '--socket', metavar='path', help='listen on this Unix socket')
+	listen.add_argument('-p', '--port', type=int, help='listen on this localhost port')
+	parser.add_argument('-j', '--jobs', metavar='N', type=int, default=0,
+	                    help='number of requests run at once (default 0, one per CPU)')
+	parser.add_argument('-q', '--queue', metavar='N', type=int, default=64,
+	                    help='number of requests queued before new ones are refused (default 64)')
+	parser.add_argument('-v', '--verbose', action='count', default=0, help='verbose output')
+	args = parser.parse_args()
+
+	if args.socket is not None:
+		if os.path.exists(args.socket):
+			os.remove(args.socket)
+		server = UnixHTTPServer(args.socket, RequestHandler)
+		address = args.socket
+	else:
+		server = http.server.ThreadingHTTPServer(('127.0.0.1', args.port), RequestHandler)
+		address = f'http://127.0.0.1:{server.server_address[1]}'
+
+	server.extraction = ExtractionServer(args.jobs or os.cpu_count() or 1, args.queue, args.verbose)
+	print(f"Listening on {address}", file=sys.stderr)
+
+	# Stop cleanly when terminated as well as when interrupted, removing any socket
+	signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+		if args.socket is not None and os.path.exists(args.socket):
+			os.remove(args.socket)
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())